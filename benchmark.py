@@ -0,0 +1,345 @@
+# author:sursen
+# Offline benchmark of the sursen iscsi driver, no storage or network:
+#   FakeLioExecutor: stands in for cinder-rtstool behind set_execute
+#   FakeDevTree: temp /dev with N devices and disk/by-path links
+#   Benchmark: attach/detach, bulk ensure_exports and detach_initiator,
+#              device lookups and initiator table persistence at each
+#              scale, plus lock waits, as json
+#
+#   python -m cinder.volume.drivers.sursen.benchmark [-o out.json]
+#          [--scales 10,1000,10000] [--exec-latency 0.0]
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import getopt
+import tempfile
+import platform
+from cinder.volume.drivers.sursen import common
+from cinder.volume.drivers.sursen import metrics
+from cinder.volume.drivers.sursen import iscsipatch
+from cinder.volume.drivers.sursen import surdrivers
+from cinder.openstack.common import processutils as putils
+
+IQN_PREFIX = 'iqn.2010-10.org.openstack:'
+CONNECTOR = {'initiator': 'iqn.1993-08.org.debian:01:benchhost',
+             'ip': '127.0.0.1', 'host': 'benchhost'}
+
+
+def _percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    total = sum(samples)
+
+    def _at(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {'count': len(samples), 'total_s': total,
+            'ops_per_s': len(samples) / total if total else 0.0,
+            'p50_ms': _at(0.5) * 1000, 'p99_ms': _at(0.99) * 1000,
+            'max_ms': samples[-1] * 1000}
+
+
+def _timed(samples, func, *args):
+    start = time.time()
+    result = func(*args)
+    samples.append(time.time() - start)
+    return result
+
+
+class FakeLioExecutor(object):
+    """utils.execute replacement keeping LIO targets and ACLs in memory.
+
+    latency seconds are slept per call to model the fork/exec of the
+    real tool; calls counts every command by name.
+    """
+    def __init__(self, latency=0.0, zvols=()):
+        self.latency = latency
+        self.targets = {}
+        self.calls = {}
+        # answers for `zfs list -Hp -o name,type,used,avail,refer,volsize,..`
+        self.zfs_list = ''.join('%s\tvolume\t0\t0\t0\t1073741824\t-\n' % z
+                                for z in zvols)
+
+    def _fail(self, cmd, msg):
+        raise putils.ProcessExecutionError(description=msg,
+                                           cmd=' '.join(cmd))
+
+    def __call__(self, *cmd, **kwargs):
+        name = os.path.basename(cmd[0])
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if name == 'zfs' and cmd[1] == 'list':
+            return (self.zfs_list, '')
+        if name != 'cinder-rtstool':
+            return ('', '')
+        op, args = cmd[1], cmd[2:]
+        if op == 'create':
+            if args[1] in self.targets:
+                self._fail(cmd, 'target exists')
+            self.targets[args[1]] = set()
+        elif op == 'add-initiator':
+            if args[0] not in self.targets:
+                self._fail(cmd, 'no such target')
+            self.targets[args[0]].add(args[3])
+        elif op == 'delete-initiator':
+            self.targets.get(args[0], set()).discard(args[1])
+        elif op == 'delete':
+            self.targets.pop(args[0], None)
+        return ('', '')
+
+
+class FakeDevTree(object):
+    """root/sd<N> devices plus root/disk/by-path iscsi links to them."""
+    def __init__(self, volume_names):
+        self.root = tempfile.mkdtemp(prefix='surbench-dev-')
+        bypath = os.path.join(self.root, 'disk', 'by-path')
+        os.makedirs(bypath)
+        self.devices = {}
+        for (index, name) in enumerate(volume_names):
+            dev = 'sd%s' % self._letters(index)
+            open(os.path.join(self.root, dev), 'w').close()
+            os.symlink('../../%s' % dev, os.path.join(
+                bypath, 'ip-127.0.0.1:3260-iscsi-%s%s-lun-0'
+                % (IQN_PREFIX, name)))
+            self.devices[name] = dev
+
+    def _letters(self, index):
+        letters = ''
+        index += 1
+        while index:
+            (index, rest) = divmod(index - 1, 26)
+            letters = chr(ord('a') + rest) + letters
+        return letters
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class FakeConfiguration(object):
+    """Option defaults of volume_opts with overrides, safe_get included."""
+    def __init__(self, **overrides):
+        self._values = dict((opt.dest, opt.default)
+                            for opt in surdrivers.volume_opts)
+        self._values.update(overrides)
+
+    def append_config_values(self, opts):
+        for opt in opts:
+            self._values.setdefault(opt.dest, opt.default)
+
+    def safe_get(self, name):
+        return self._values.get(name)
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeDb(object):
+    def __init__(self, volumes):
+        self.volumes = dict((v['id'], v) for v in volumes)
+
+    def volume_get(self, context, volume_id):
+        return self.volumes[volume_id]
+
+    def volume_get_all_by_host(self, context, host):
+        return [v for v in self.volumes.values() if v['host'] == host]
+
+    def volume_update(self, context, volume_id, values):
+        self.volumes[volume_id].update(values)
+
+
+class _FakeTargetHelper(object):
+    def __init__(self, db):
+        self.db = db
+
+    def _get_target_chap_auth(self, context, iscsi_name):
+        raise KeyError(iscsi_name)
+
+    def _iscsi_location(self, ip, target, iqn, port, lun=None):
+        return '%s:%s,%s %s %s' % (ip, port, target, iqn, lun)
+
+    def _iscsi_authentication(self, chap, name, password):
+        return '%s %s %s' % (chap, name, password)
+
+
+class _FakeISCSIDriver(object):
+    def validate_connector(self, connector):
+        return True
+
+    def _get_iscsi_properties(self, volume):
+        (portal, iqn, lun) = volume['provider_location'].split(' ')[:3]
+        return {'target_portal': portal.split(',')[0], 'target_iqn': iqn,
+                'target_lun': lun, 'volume_id': volume['id']}
+
+
+class _BenchDriver(surdrivers.SurIscsiVolumeDriver):
+    def _get_volume_devpath(self, volume_name):
+        return os.path.join(self.configuration.safe_get('bench_dev_root'),
+                            self.configuration.safe_get('bench_devices')
+                            [volume_name])
+
+
+class Benchmark(object):
+    def __init__(self, scales=(10, 1000, 10000), exec_latency=0.0,
+                 lookup_samples=1000, seed=42):
+        self.scales = scales
+        self.exec_latency = exec_latency
+        self.lookup_samples = lookup_samples
+        self.random = random.Random(seed)
+
+    def _volumes(self, count):
+        return [{'id': '%08x-0000-4000-8000-%012x' % (n, n),
+                 'name': 'volume-%08x-0000-4000-8000-%012x' % (n, n),
+                 'host': 'benchhost@sursen', 'size': 1,
+                 'provider_location': None, 'provider_auth': None}
+                for n in range(count)]
+
+    def _driver(self, workdir, devtree, db, executor):
+        surdrivers.CONF.set_override('iscsi_helper', 'lioadm')
+        conf = FakeConfiguration(
+            iscsi_target_prefix=IQN_PREFIX,
+            initiator_path=os.path.join(workdir, 'initiatortable.ini'),
+            initiator_registry_path=os.path.join(workdir,
+                                                 'initiatortable.db'),
+            lio_daemon_socket=None, zfspool='benchpool',
+            metrics_enabled=True,
+            sur_lock_path=os.path.join(workdir, 'locks'),
+            iscsi_ip_address='127.0.0.1', iscsi_port=3260,
+            bench_dev_root=devtree.root, bench_devices=devtree.devices)
+        # create_cinder_file goes through rootwrap, not the fake
+        open(conf.initiator_path, 'a').close()
+        drv = _BenchDriver(configuration=conf, db=db,
+                           host='benchhost@sursen')
+        drv.set_execute(executor)
+        # collaborators that would talk to a real cinder backend
+        drv.iscsiobj = _FakeISCSIDriver()
+        drv.target_helper = _FakeTargetHelper(db)
+        return drv
+
+    def _bench_attach_detach(self, drv, volumes):
+        attach, detach = [], []
+        for volume in volumes:
+            start = time.time()
+            volume.update(drv._create_export(None, volume))
+            drv.initialize_connection(volume, CONNECTOR)
+            attach.append(time.time() - start)
+        for volume in volumes:
+            _timed(detach, drv.remove_export, None, volume)
+        return {'attach': _percentiles(attach),
+                'detach': _percentiles(detach)}
+
+    def _bench_ensure_exports(self, drv, volumes):
+        # every volume was attached once, so it has auth and an initiator
+        drv.initiator_manager.add_vol_initname_pairs(
+            [(v['id'], CONNECTOR['initiator']) for v in volumes])
+        start = time.time()
+        failures = drv.ensure_exports(None, volumes)
+        return {'seconds': time.time() - start, 'volumes': len(volumes),
+                'failed': len(failures)}
+
+    def _bench_detach_initiator(self, drv, volumes):
+        # after ensure_exports every volume is exported to CONNECTOR
+        start = time.time()
+        failures = drv.detach_initiator(None, CONNECTOR['initiator'])
+        return {'seconds': time.time() - start, 'volumes': len(volumes),
+                'failed': len(failures)}
+
+    def _bench_dev_lookup(self, devtree, volumes):
+        manager = common.DevManager(devtree.root)
+        sample = [v['name'] for v in volumes]
+        self.random.shuffle(sample)
+        sample = sample[:self.lookup_samples]
+        cold, warm = [], []
+        _timed(cold, manager.get_devname_by_volumename, sample[0])
+        for name in sample:
+            _timed(warm, manager.get_devname_by_volumename, name)
+        return {'cold': _percentiles(cold), 'warm': _percentiles(warm)}
+
+    def _bench_initiator_store(self, workdir, volumes, executor):
+        result = {}
+        for (label, registry) in (('ini', None), ('registry', 'reg.db')):
+            path = os.path.join(workdir, 'store-%s.ini' % label)
+            open(path, 'a').close()
+            manager = iscsipatch.InitiatorManager(
+                path, executor, 'true',
+                registry_path=registry and os.path.join(workdir, registry))
+            add, remove = [], []
+            for volume in volumes:
+                _timed(add, manager.add_vol_initname_pair, volume['id'],
+                       CONNECTOR['initiator'])
+            for volume in volumes:
+                _timed(remove, manager.remove_vol_initname_pair,
+                       volume['id'])
+            result[label] = {'add': _percentiles(add),
+                             'remove': _percentiles(remove)}
+        return result
+
+    def run_scale(self, count):
+        workdir = tempfile.mkdtemp(prefix='surbench-')
+        volumes = self._volumes(count)
+        devtree = FakeDevTree([v['name'] for v in volumes])
+        executor = FakeLioExecutor(self.exec_latency,
+                                   ['benchpool/%s' % v['name']
+                                    for v in volumes])
+        metrics.REGISTRY.configure(True)
+        metrics.REGISTRY.reset()
+        try:
+            db = FakeDb(volumes)
+            drv = self._driver(workdir, devtree, db, executor)
+            result = {'volumes': count}
+            result.update(self._bench_attach_detach(drv, volumes))
+            result['ensure_exports'] = self._bench_ensure_exports(drv,
+                                                                  volumes)
+            result['detach_initiator'] = self._bench_detach_initiator(
+                drv, volumes)
+            result['dev_lookup'] = self._bench_dev_lookup(devtree, volumes)
+            result['initiator_store'] = self._bench_initiator_store(
+                workdir, volumes, executor)
+            result['commands'] = dict(executor.calls)
+            result['startup'] = drv.get_startup_report()
+            result['locks'] = drv.get_lock_stats()
+            result['metrics'] = metrics.REGISTRY.to_dict()['operations']
+            return result
+        finally:
+            metrics.REGISTRY.configure(False)
+            devtree.cleanup()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def run(self):
+        return {'driver': surdrivers.SurIscsiVolumeDriver.VERSION,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'timestamp': int(time.time()),
+                'exec_latency': self.exec_latency,
+                'results': [self.run_scale(count) for count in self.scales]}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    try:
+        (opts, _) = getopt.getopt(argv, 'o:', ['scales=', 'exec-latency='])
+    except getopt.GetoptError as e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    opts = dict(opts)
+    scales = tuple(int(s) for s in
+                   opts.get('--scales', '10,1000,10000').split(','))
+    bench = Benchmark(scales=scales,
+                      exec_latency=float(opts.get('--exec-latency', 0.0)))
+    data = json.dumps(bench.run(), indent=1, sort_keys=True)
+    if '-o' in opts:
+        with open(opts['-o'], 'w') as f:
+            f.write(data + '\n')
+    else:
+        sys.stdout.write(data + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+# author:sursen
+# ChunkHashIndex: per-volume array of chunk hashes, saved under
+#                 cbt_index_dir
+# ChangeTracker: diffs a volume against its last index for a destination
+#                to find the extents an incremental backup or re-sync has
+#                to move
+import os
+import io
+import zlib
+import glob
+import array
+import hashlib
+import struct
+import logging
+import tempfile
+import multiprocessing
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+LOG = logging.getLogger(__name__)
+
+# python 2 has no 'Q', its 'L' is 64 bit on the 64 bit hosts we run on
+try:
+    array.array('Q')
+    _TYPECODE = 'Q'
+except ValueError:
+    _TYPECODE = 'L'
+
+try:
+    _slice = buffer
+except NameError:
+    def _slice(buf, offset, size):
+        return memoryview(buf)[offset:offset + size]
+
+
+def _chunk_hash(data):
+    if xxhash is not None:
+        return xxhash.xxh64(data).intdigest()
+    # two independent 32 bit sums, a change has to fool both
+    return ((zlib.crc32(data) & 0xffffffff) << 32) | \
+        (zlib.adler32(data) & 0xffffffff)
+
+
+def _hash_range(args):
+    """Hashes of chunks [first, last) of path, runs in a pool worker."""
+    (path, chunk_size, first, last, size, blocksize) = args
+    hashes = []
+    # one chunk buffer per worker, filled in place
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    reader = io.FileIO(path, 'r')
+    try:
+        reader.seek(first * chunk_size)
+        for index in range(first, last):
+            want = min(chunk_size, size - index * chunk_size)
+            got = 0
+            while got < want:
+                n = reader.readinto(view[got:got + min(blocksize,
+                                                       want - got)])
+                if not n:
+                    break
+                got += n
+            hashes.append(_chunk_hash(_slice(buf, 0, got)))
+    finally:
+        reader.close()
+    return hashes
+
+
+class ChunkHashIndex(object):
+    """One 64 bit hash per fixed-size chunk, kept in an array."""
+    MAGIC = b'SURCBT01'
+    _HEADER = struct.Struct('<8sQQ')
+
+    def __init__(self, chunk_size, size, hashes=None):
+        self.chunk_size = chunk_size
+        self.size = size
+        if hashes is None:
+            hashes = array.array(_TYPECODE)
+        self.hashes = hashes
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+        except IOError:
+            return None
+        if len(raw) < cls._HEADER.size:
+            return None
+        (magic, chunk_size, size) = cls._HEADER.unpack_from(raw)
+        if magic != cls.MAGIC:
+            return None
+        hashes = array.array(_TYPECODE)
+        body = raw[cls._HEADER.size:]
+        if len(body) % hashes.itemsize:
+            return None
+        if hasattr(hashes, 'frombytes'):
+            hashes.frombytes(body)
+        else:
+            hashes.fromstring(body)
+        return cls(chunk_size, size, hashes)
+
+    def save(self, path):
+        dirname = os.path.dirname(os.path.abspath(path))
+        (fd, tmppath) = tempfile.mkstemp(dir=dirname, prefix='.cbt.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._HEADER.pack(self.MAGIC, self.chunk_size,
+                                          self.size))
+                if hasattr(self.hashes, 'tobytes'):
+                    f.write(self.hashes.tobytes())
+                else:
+                    f.write(self.hashes.tostring())
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmppath, path)
+        except:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+
+    def changed_extents(self, old):
+        """(offset, length) ranges that differ from old, merged.
+
+        Everything is reported when old is None or was built with a
+        different chunk size.
+        """
+        if old is None or old.chunk_size != self.chunk_size:
+            return [(0, self.size)] if self.size else []
+        extents = []
+        for index, value in enumerate(self.hashes):
+            if index < len(old.hashes) and old.hashes[index] == value:
+                continue
+            offset = index * self.chunk_size
+            length = min(self.chunk_size, self.size - offset)
+            if extents and extents[-1][0] + extents[-1][1] == offset:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+            else:
+                extents.append((offset, length))
+        return extents
+
+
+def hash_volume(path, size, chunk_size=4 * 1024 * 1024, processes=None,
+                blocksize=1024 * 1024):
+    """Build the ChunkHashIndex of path, chunks hashed across processes."""
+    nchunks = (size + chunk_size - 1) // chunk_size
+    processes = processes or multiprocessing.cpu_count()
+    step = max(1, (nchunks + processes * 4 - 1) // (processes * 4))
+    jobs = [(path, chunk_size, first, min(first + step, nchunks), size,
+             blocksize) for first in range(0, nchunks, step)]
+    hashes = array.array(_TYPECODE)
+    if processes <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            hashes.extend(_hash_range(job))
+    else:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            for part in pool.imap(_hash_range, jobs):
+                hashes.extend(part)
+        finally:
+            pool.close()
+            pool.join()
+    return ChunkHashIndex(chunk_size, size, hashes)
+
+
+def copy_extents(src_path, dst_path, extents, blocksize=1024 * 1024):
+    """Copy only the given (offset, length) ranges from src to dst."""
+    src_fd = os.open(src_path, os.O_RDONLY)
+    dst_fd = os.open(dst_path, os.O_WRONLY)
+    copied = 0
+    try:
+        for (offset, length) in extents:
+            end = offset + length
+            while offset < end:
+                os.lseek(src_fd, offset, os.SEEK_SET)
+                data = os.read(src_fd, min(blocksize, end - offset))
+                if not data:
+                    break
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                written = 0
+                while written < len(data):
+                    written += os.write(dst_fd, data[written:])
+                offset += len(data)
+                copied += len(data)
+        os.fsync(dst_fd)
+    finally:
+        os.close(dst_fd)
+        os.close(src_fd)
+    return copied
+
+
+class ChangeTracker(object):
+    """Keeps a ChunkHashIndex per volume and destination under index_dir.
+
+    diff() returns the changed extents and the new index; call commit()
+    with that index once the extents were transferred, so a failed
+    transfer is retried in full the next time. An index only says what
+    the destination it was committed for holds, a destination without
+    one gets the whole volume.
+    """
+    def __init__(self, index_dir, chunk_size=4 * 1024 * 1024,
+                 processes=None):
+        self.index_dir = index_dir
+        self.chunk_size = chunk_size
+        self.processes = processes
+
+    def index_path(self, volume_name, target=None):
+        if target is None:
+            return os.path.join(self.index_dir, volume_name + '.cbt')
+        key = hashlib.sha1(str(target).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.index_dir,
+                            '%s.%s.cbt' % (volume_name, key))
+
+    def diff(self, volume_name, device_path, size, target=None):
+        new = hash_volume(device_path, size, self.chunk_size, self.processes)
+        old = ChunkHashIndex.load(self.index_path(volume_name, target))
+        if old is not None and old.size != size:
+            old = None
+        extents = new.changed_extents(old)
+        LOG.info('%s: %d changed extents, %d of %d bytes'
+                 % (volume_name, len(extents),
+                    sum(l for (_, l) in extents), size))
+        return (extents, new)
+
+    def commit(self, volume_name, index, target=None):
+        if not os.path.isdir(self.index_dir):
+            os.makedirs(self.index_dir)
+        index.save(self.index_path(volume_name, target))
+
+    def forget(self, volume_name, target=None):
+        """Drop the index of one destination, or of all of them."""
+        if target is not None:
+            paths = [self.index_path(volume_name, target)]
+        else:
+            paths = [self.index_path(volume_name)] + glob.glob(
+                os.path.join(self.index_dir, volume_name + '.*.cbt'))
+        for path in paths:
+            if os.path.exists(path):
+                os.unlink(path)
@@ -1,21 +1,190 @@
 # author:sursen
-# INIConfig: read or write ini
+# INIConfig: read or write ini, optionally write-behind
 # SysCmdExecute: command line executer
+# CmdExecutor: argv command runner with timeout, streaming and bounded pool
+# LRUCache: bounded least-recently-used mapping with hit/miss counters
+# LazyModule: module imported on first attribute access
+# native_module: unpatched threading/Queue for blocking I/O workers
+# lazy_property: attribute built on first access, then a plain attribute
+# StartupTimer: per-phase start-up timings
 # CommonUtils:common tools
 import os
+import re
+import time
+import errno
+import fcntl
+import ctypes
+import select
+import signal
+import struct
+import ctypes.util
+import atexit
+import weakref
+import contextlib
+import tempfile
+import threading
 import subprocess
+import collections
+import pwd
+import grp
 import ConfigParser
+from multiprocessing.pool import ThreadPool
 from tarfile import TUREAD
+from cinder.volume.drivers.sursen import metrics
+
+# path -> (file signature, sections snapshot), shared by all INIConfig
+# instances of this process so an unchanged file is parsed only once
+_INI_CACHE = {}
+_INI_CACHE_LOCK = threading.Lock()
+_WRITE_BEHIND_CONFIGS = weakref.WeakValueDictionary()
+# files already provisioned by CommonUtils.create_cinder_file
+_PROVISIONED_FILES = set()
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+def _copy_sections(sections, dict_type=dict):
+    result = dict_type()
+    for name, options in sections.items():
+        result[name] = dict_type(options)
+    return result
+
+
+def _flush_write_behind_configs():
+    for config in list(_WRITE_BEHIND_CONFIGS.values()):
+        config.flush()
+
+atexit.register(_flush_write_behind_configs)
+
+
+class _FileLock(object):
+    """Inter-process lock next to path, falls back to the parent dir.
+
+    Polled with LOCK_NB and short sleeps like locks.HostLock, so waiting
+    on another process yields to the eventlet hub instead of blocking it.
+    """
+    def __init__(self, path, poll_min=0.001, poll_max=0.05):
+        self.path = path
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.fd = None
+
+    def __enter__(self):
+        try:
+            self.fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            self.fd = os.open(os.path.dirname(os.path.abspath(self.path)),
+                              os.O_RDONLY)
+        delay = self.poll_min
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return self
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(self.fd)
+                    self.fd = None
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, self.poll_max)
+
+    def __exit__(self, *exc_info):
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
 
 class INIConfig(object):
-    def __init__(self, path):
+    """Read or write an ini file.
+
+    With write_behind=True mutations are kept in memory and written by
+    op_execute only once flush_threshold changes are pending; otherwise
+    they are written flush_interval seconds after the first change or on
+    an explicit flush(). Every write is a temp file + rename done under
+    an inter-process file lock.
+    """
+    def __init__(self, path, write_behind=False, flush_interval=2.0,
+                 flush_threshold=64):
         if path is None:
             raise NameError('path is none!!!!')
             return
         self.path = path
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
         self.cf = ConfigParser.ConfigParser()
-        self.cf.read(self.path)
         self.sign = False
+        self._lock = threading.RLock()
+        self._pending = []
+        self._timer = None
+        self._signature = None
+        self._load()
+        if write_behind:
+            _WRITE_BEHIND_CONFIGS[id(self)] = self
+
+    def _load(self):
+        signature = _file_signature(self.path)
+        with _INI_CACHE_LOCK:
+            cached = _INI_CACHE.get(self.path)
+        if signature is not None and cached is not None \
+                and cached[0] == signature:
+            self.cf._sections = _copy_sections(cached[1], self.cf._dict)
+        else:
+            self.cf = ConfigParser.ConfigParser()
+            self.cf.read(self.path)
+            self._store_cache(signature)
+        self._signature = signature
+
+    def _store_cache(self, signature):
+        if signature is None:
+            return
+        with _INI_CACHE_LOCK:
+            _INI_CACHE[self.path] = (signature,
+                                     _copy_sections(self.cf._sections,
+                                                    self.cf._dict))
+
+    def _record(self, op):
+        # coalesce: a later change of the same key/section wins
+        target = op[1:3] if op[0] in ('set', 'remove_key') else op[1:2]
+        self._pending = [p for p in self._pending
+                         if (p[1:3] if p[0] in ('set', 'remove_key')
+                             else p[1:2]) != target]
+        self._pending.append(op)
+
+    def _replay(self):
+        for op in self._pending:
+            try:
+                if op[0] == 'set':
+                    if not self.cf.has_section(op[1]):
+                        self.cf.add_section(op[1])
+                    self.cf.set(op[1], op[2], op[3])
+                elif op[0] == 'remove_key':
+                    self.cf.remove_option(op[1], op[2])
+                elif op[0] == 'create_section':
+                    if not self.cf.has_section(op[1]):
+                        self.cf.add_section(op[1])
+                elif op[0] == 'remove_section':
+                    self.cf.remove_section(op[1])
+            except ConfigParser.Error:
+                continue
+
+    def reload_if_changed(self):
+        """Re-read the file only if its inode/mtime/size changed."""
+        with self._lock:
+            signature = _file_signature(self.path)
+            if signature == self._signature:
+                return False
+            self._load()
+            self._replay()
+            return True
         
     def get(self, field, key):
         result = ""
@@ -26,19 +195,23 @@ class INIConfig(object):
         return result
    
     def set(self, field, key, value):
-        try:
-            self.cf.set(field, key, value)
-        except:
-            return False
-        self.sign = True
+        with self._lock:
+            try:
+                self.cf.set(field, key, value)
+            except:
+                return False
+            self._record(('set', field, key, value))
+            self.sign = True
         return True
     
     def remove_key(self, field, key):
-        try:
-            self.cf.remove_option(field, key)
-        except:
-            return False
-        self.sign = True
+        with self._lock:
+            try:
+                self.cf.remove_option(field, key)
+            except:
+                return False
+            self._record(('remove_key', field, key))
+            self.sign = True
         return True
     
     def get_options(self,field):
@@ -48,42 +221,398 @@ class INIConfig(object):
         return self.cf.sections()
     
     def create_seciton(self,name):
-        self.cf.add_section(name)
-        self.sign=True
+        with self._lock:
+            self.cf.add_section(name)
+            self._record(('create_section', name))
+            self.sign=True
     
     def remove_section(self,name):
-        self.cf.remove_section(name)
-        self.sign=True
+        with self._lock:
+            self.cf.remove_section(name)
+            self._record(('remove_section', name))
+            self.sign=True
        
     
+    @metrics.timed('ini_op_execute')
     def op_execute(self):
         if self.sign == False:
-            return True        
+            return True
+        if not self.write_behind or \
+                len(self._pending) >= self.flush_threshold:
+            return self.flush()
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_interval,
+                                              self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return True
+
+    def flush(self):
+        """Write all pending changes with one atomic rename."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.sign == False:
+                return True
+            try:
+                with _FileLock(self.path):
+                    # another process may have written the file meanwhile,
+                    # merge our changes on top of its content
+                    if _file_signature(self.path) != self._signature:
+                        self._load()
+                        self._replay()
+                    self._write_atomic()
+                    self._signature = _file_signature(self.path)
+            except (IOError, OSError):
+                return False
+            self._store_cache(self._signature)
+            self._pending = []
+            self.sign = False
+        return True
+
+    def _write_atomic(self):
+        dirname = os.path.dirname(os.path.abspath(self.path))
         try:
-            self.cf.write(open(self.path, 'w'))
+            fd, tmppath = tempfile.mkstemp(
+                dir=dirname, prefix='.%s.' % os.path.basename(self.path))
+        except OSError as e:
+            if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            # directory not writable for us, rewrite in place instead
+            with open(self.path, 'w') as f:
+                self.cf.write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                self.cf.write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self.path):
+                st = os.stat(self.path)
+                os.chmod(tmppath, st.st_mode & 0o7777)
+            os.rename(tmppath, self.path)
         except:
-            return False
-        return True
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+        dirfd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
 
 class SysCmdExecute(object):
-    def __init__(self, path=None):
+    def __init__(self, path=None, timeout=None):
         self.outstr = ''
         self.rtcode = 1
         self.outerr = '' 
+        self.timeout = timeout
+        self.timed_out = False
 
     def sys_cmd_exec(self, cmdstr):
         if cmdstr is None:
             return (self.outstr, self.rtcode)
-        mchild = subprocess.Popen(cmdstr, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        self.rtcode = mchild.wait()
-        (self.outstr, self.outerr) = mchild.communicate()          
+        # a string keeps the old shell semantics, a list runs as argv
+        with metrics.record('sys_cmd') as rec:
+            rec.tag = metrics.command_tag(cmdstr)
+            rec.argv = cmdstr
+            result = _default_executor().execute(
+                cmdstr, timeout=self.timeout,
+                shell=isinstance(cmdstr, basestring))
+        (self.outstr, self.rtcode, self.outerr) = result
+        self.timed_out = result.timed_out
         return (self.outstr, self.rtcode, self.outerr)
-    
+
+
+class CmdStream(object):
+    """Iterates over the stdout lines of a running command.
+
+    rtcode and outerr are set once the iteration is finished.
+    """
+    def __init__(self, executor, argv, timeout=None, shell=False):
+        self.executor = executor
+        self.argv = argv
+        self.timeout = timeout
+        self.shell = shell
+        self.rtcode = None
+        self.outerr = ''
+        self.timed_out = False
+
+    def __iter__(self):
+        errs = []
+        with self.executor._slots:
+            child = self.executor._popen(self.argv, self.shell)
+            # stderr is drained aside so neither pipe can fill up and block
+            reader = threading.Thread(target=lambda: errs.append(
+                child.stderr.read()))
+            reader.daemon = True
+            reader.start()
+            timer = self.executor._start_timer(child, self.timeout, self)
+            try:
+                for line in iter(child.stdout.readline, b''):
+                    yield line
+            finally:
+                child.stdout.close()
+                self.rtcode = child.wait()
+                if timer is not None:
+                    timer.cancel()
+                reader.join()
+                self.outerr = ''.join(errs)
+
+
+class CmdResult(tuple):
+    """(out, rc, err) of CmdExecutor.execute, plus timed_out."""
+    def __new__(cls, out, rc, err, timed_out=False):
+        result = tuple.__new__(cls, (out, rc, err))
+        result.timed_out = timed_out
+        return result
+
+
+class _Deadline(object):
+    timed_out = False
+
+
+class CmdExecutor(object):
+    """argv based command runner.
+
+    At most max_workers commands run at the same time, whether they are
+    started with execute(), stream() or fanned out with map()/submit().
+    Every command runs in its own process group. One running longer than
+    its timeout is killed with the whole group, so children of a shell
+    pipeline cannot keep the pipes open, and is reported with timed_out
+    set and the kill signal as negative return code.
+    """
+    def __init__(self, max_workers=8, timeout=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _popen(self, argv, shell):
+        return subprocess.Popen(argv, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, shell=shell,
+                                close_fds=True, preexec_fn=os.setsid)
+
+    def _start_timer(self, child, timeout, holder=None):
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return None
+
+        def _kill():
+            if holder is not None:
+                holder.timed_out = True
+            try:
+                os.killpg(child.pid, signal.SIGKILL)
+            except OSError:
+                try:
+                    child.kill()
+                except OSError:
+                    pass
+        timer = threading.Timer(timeout, _kill)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def execute(self, argv, timeout=None, line_callback=None, shell=False):
+        """Run argv and return a CmdResult, (out, rc, err) + timed_out.
+
+        With line_callback every stdout line is handed to it as soon as it
+        is read and out is returned empty instead of being accumulated.
+        """
+        if line_callback is not None:
+            stream = self.stream(argv, timeout=timeout, shell=shell)
+            for line in stream:
+                line_callback(line)
+            return CmdResult('', stream.rtcode, stream.outerr,
+                             stream.timed_out)
+        deadline = _Deadline()
+        with self._slots:
+            child = self._popen(argv, shell)
+            timer = self._start_timer(child, timeout, deadline)
+            try:
+                (out, err) = child.communicate()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+        return CmdResult(out, child.returncode, err, deadline.timed_out)
+
+    def stream(self, argv, timeout=None, shell=False):
+        return CmdStream(self, argv, timeout=timeout, shell=shell)
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_workers)
+            return self._pool
+
+    def submit(self, argv, timeout=None):
+        """Run argv on the worker pool, .get() returns (out, rc, err)."""
+        return self._get_pool().apply_async(self.execute, (argv, timeout))
+
+    def map(self, argvs, timeout=None):
+        """Run all argvs on the worker pool, results keep argvs order."""
+        results = [self.submit(argv, timeout) for argv in argvs]
+        return [r.get() for r in results]
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+_DEFAULT_EXECUTOR = []
+_DEFAULT_EXECUTOR_LOCK = threading.Lock()
+
+
+def _default_executor():
+    with _DEFAULT_EXECUTOR_LOCK:
+        if len(_DEFAULT_EXECUTOR) == 0:
+            _DEFAULT_EXECUTOR.append(CmdExecutor())
+        return _DEFAULT_EXECUTOR[0]
+
+
+class _Inotify(object):
+    """Minimal inotify watch on one directory through libc."""
+    IN_CREATE = 0x00000100
+    IN_MOVED_TO = 0x00000080
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self, path, mask=IN_CREATE | IN_MOVED_TO):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8')
+        if libc.inotify_add_watch(self.fd, path, mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed')
+
+    def read_names(self, timeout):
+        """Names created in the directory, [] if nothing within timeout."""
+        (ready, _, _) = select.select([self.fd], [], [], max(timeout, 0))
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        names = []
+        offset = 0
+        while offset + self._EVENT.size <= len(buf):
+            (_, _, _, length) = self._EVENT.unpack_from(buf, offset)
+            offset += self._EVENT.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.append(name.decode('utf-8') if bytes is not str
+                             else name)
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+# by-path link of an iscsi lun: ip-<portal>-iscsi-<iqn prefix>:<name>-lun-<n>
+_ISCSI_LINK = re.compile(r'.*-iscsi-.*:(.+)-lun-\d+$')
+
+
 class DevManager(object):
     def __init__(self, path=None):
         self.path = path
         if self.path is None:
             self.path = '/dev'
+        # <path>/disk/by-* dir -> (mtime, {link name: device name})
+        self._link_dirs = {}
+        self._disk_mtime = None
+        # volume name -> its devices, rebuilt when a by-* dir changes
+        self._volume_devs = {}
+        self._index_lock = threading.Lock()
+
+    def invalidate(self):
+        """Drop the device index, the next lookup rebuilds it."""
+        with self._index_lock:
+            self._link_dirs = {}
+            self._disk_mtime = None
+            self._volume_devs = {}
+
+    def _scan_link_dir(self, dirpath):
+        links = {}
+        try:
+            names = os.listdir(dirpath)
+        except OSError:
+            return links
+        for name in names:
+            try:
+                target = os.readlink(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            links[name] = os.path.basename(target)
+        return links
+
+    def _refresh_index(self):
+        # a stat per by-* directory tells whether udev touched it
+        diskdir = os.path.join(self.path, 'disk')
+        changed = False
+        try:
+            disk_mtime = os.stat(diskdir).st_mtime
+        except OSError:
+            disk_mtime = None
+        if disk_mtime != self._disk_mtime:
+            dirs = []
+            if disk_mtime is not None:
+                dirs = [os.path.join(diskdir, n) for n in os.listdir(diskdir)
+                        if n.startswith('by-')]
+            for d in list(self._link_dirs):
+                if d not in dirs:
+                    del self._link_dirs[d]
+            for d in dirs:
+                self._link_dirs.setdefault(d, (None, {}))
+            self._disk_mtime = disk_mtime
+            changed = True
+        for d, (mtime, links) in list(self._link_dirs.items()):
+            try:
+                cur_mtime = os.stat(d).st_mtime
+            except OSError:
+                del self._link_dirs[d]
+                changed = True
+                continue
+            if cur_mtime != mtime:
+                self._link_dirs[d] = (cur_mtime, self._scan_link_dir(d))
+                changed = True
+        if changed:
+            self._volume_devs = self._build_volume_devs()
+
+    def _build_volume_devs(self):
+        # volume name -> sorted devices, from the links naming a target
+        # <iqn prefix>:<volume name>; exact names, so volume-1 never
+        # matches the link of volume-10
+        volume_devs = {}
+        for d in sorted(self._link_dirs):
+            for link, dev in self._link_dirs[d][1].items():
+                match = _ISCSI_LINK.match(link)
+                if match is None:
+                    continue
+                devs = volume_devs.setdefault(match.group(1), [])
+                if dev not in devs:
+                    devs.append(dev)
+        for devs in volume_devs.values():
+            devs.sort()
+        return volume_devs
     
     def check_dev_exist(self,devpath):
         fullpath=self.path + '/' + devpath
@@ -95,14 +624,64 @@ class DevManager(object):
     def get_dev_list(self):
         return os.listdir(self.path)
     
+    def get_newdev_names(self, begin_dev_list, end_dev_list):
+        if begin_dev_list is None or end_dev_list is None:
+            return []
+        end_devs = set(end_dev_list)
+        return [n for n in begin_dev_list if n not in end_devs]
+
     def get_newdev_name(self, begin_dev_list, end_dev_list):
         if begin_dev_list is None or end_dev_list is None:
             return None
-        for n in begin_dev_list:
-            if n in end_dev_list:
-                continue
-            else:
-                return n
+        names = self.get_newdev_names(begin_dev_list, end_dev_list)
+        if len(names) == 0:
+            return None
+        return names[0]
+
+    @metrics.timed('dev_wait')
+    def wait_for_devices(self, predicate=None, timeout=10,
+                         baseline=None, poll_interval=0.1):
+        """Block until devices not in baseline appear, at most timeout s.
+
+        Returns every new device name accepted by predicate, [] on
+        timeout. baseline defaults to the current device list; take it
+        before triggering the attach to not miss a fast udev. Creation
+        events come from inotify, polling is used when it is unavailable.
+        """
+        if baseline is None:
+            baseline = self.get_dev_list()
+        known = set(baseline)
+        deadline = time.time() + timeout
+
+        def _accept(names):
+            return sorted(set(n for n in names if n not in known and
+                              (predicate is None or predicate(n)) and
+                              self.check_dev_exist(n)))
+        try:
+            watch = _Inotify(self.path)
+        except (OSError, AttributeError):
+            watch = None
+        try:
+            # devices created before the watch was set up
+            found = _accept(self.get_dev_list())
+            while len(found) == 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if watch is None:
+                    time.sleep(min(poll_interval, remaining))
+                    found = _accept(self.get_dev_list())
+                else:
+                    found = _accept(watch.read_names(remaining))
+            if watch is not None and len(found) > 0:
+                # pick up siblings udev created in the same burst
+                found = sorted(set(found) | set(_accept(watch.read_names(0))))
+        finally:
+            if watch is not None:
+                watch.close()
+        if len(found) > 0:
+            self.invalidate()
+        return found
             
     def get_all_devs_for_volume(self, key_str=None):
         devarr = []
@@ -114,23 +693,144 @@ class DevManager(object):
                 devarr.append(n)
         return devarr
             
+    @metrics.timed('dev_lookup')
     def get_devname_by_volumename(self,volume_name,key_str=None):
         if volume_name is None:
             return None
-        devs = self.get_all_devs_for_volume(key_str)
-        lnum = len(devs)
-        if lnum == 0:
-            return None
-        sys_cmd = SysCmdExecute()
-        cmdstr = 'find /dev -type l -print0 | xargs --null file | grep -e' + volume_name
-        (out_str, r_code, _) = sys_cmd.sys_cmd_exec(cmdstr)
-        if r_code > 0:
+        with self._index_lock:
+            self._refresh_index()
+            for dev in self._volume_devs.get(volume_name, ()):
+                if key_str is None or key_str in dev:
+                    return dev
             return None
-        for n in devs:
-            zn = '../' + n
-            if zn in out_str:
-                return n
-        return None
+                
+class LRUCache(object):
+    """Bounded mapping, the least recently used entry is evicted first."""
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def put_many(self, items):
+        for (key, value) in items:
+            self.put(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class LazyModule(object):
+    """Stands in for a module until one of its attributes is used."""
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            self.__module = __import__(self.__name, fromlist=['*'])
+        return getattr(self.__module, attr)
+
+
+def native_module(name):
+    """The module as it was before eventlet monkey patching, if any.
+
+    Workers doing blocking file or device I/O must be OS threads, green
+    threads would stall the hub.
+    """
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return __import__(name)
+    return patcher.original(name)
+
+
+class lazy_property(object):
+    """Calls the method once on first access and stores the result.
+
+    The result lands in the instance dict, so later reads are plain
+    attribute reads and the attribute can still be assigned. The build
+    time is added to the instance's startup_timer when it has one.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+        # reentrant, one lazy attribute may be built from another
+        self._lock = threading.RLock()
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        with self._lock:
+            # another thread may have built it while we waited
+            if self.name in obj.__dict__:
+                return obj.__dict__[self.name]
+            timer = obj.__dict__.get('startup_timer')
+            if timer is None:
+                value = self.func(obj)
+            else:
+                with timer.phase(self.name):
+                    value = self.func(obj)
+            obj.__dict__[self.name] = value
+        return value
+
+
+class StartupTimer(object):
+    """Wall time per named phase, in the order the phases ran."""
+    def __init__(self, name):
+        self.name = name
+        self.phases = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0) +
+                                 time.time() - start)
+
+    def total(self):
+        return sum(self.phases.values())
+
+    def report(self):
+        return '%s start-up %.1fms: %s' % (
+            self.name, self.total() * 1000,
+            ', '.join('%s %.1fms' % (name, seconds * 1000)
+                      for (name, seconds) in self.phases.items()))
+
                 
 class CommonUtils(object):
     def __init__(self):
@@ -145,76 +845,31 @@ class CommonUtils(object):
         slen = len(sub_str)
         return all_str[index + slen]
     
-    def get_sizesign_from_str(self, f_str):
-        if f_str is None:
-            return f_str
-        if 'G' in f_str:
-            return 'G'
-        if 'T' in f_str:
-            return 'T'
-        if 'M' in f_str:
-            return 'M'
-    
-    def format_size(self, floatstr, signstr, basesign):
-        if floatstr is None or signstr is None:
-            return floatstr
-        if basesign == 'G':
-            if signstr == 'M':
-                tmpnum = float(floatstr) / 1024
-                return ('%.2f' % tmpnum)
-            if signstr == 'G':
-                return floatstr
-            if signstr == 'T':
-                tmpnum = float(floatstr) * 1000
-                return ('%.2f' % tmpnum)
-            
-        if basesign == 'M':
-            if signstr == 'G':
-                tmpnum = float(floatstr) * 1000
-                return ('%.2f' % tmpnum)
-            if signstr == 'M':
-                return floatstr
-            if signstr == 'T':
-                tmpnum = float(floatstr) * 1000 * 1000
-                return ('%.2f' % tmpnum)
-            
-        if basesign == 'T':
-            if signstr == 'G':
-                tmpnum = float(floatstr) / 1024
-                return ('%.2f' % tmpnum)
-            if signstr == 'T':
-                return floatstr
-            if signstr == 'M':
-                tmpnum = float(floatstr) / 1024 / 1024
-                return ('%.2f' % tmpnum)       
-              
-        return floatstr        
-            
-    def get_float_from_str(self, cstr=None):
-        if cstr is None:
-            return None
-        def f(x):
-            if str(x).isdigit() or str(x) == ".":
-                return x
-            return
-        return filter(f, cstr)
-    
-    def create_cinder_file(self,m_execute,m_r_helper,file_path):
-        if os.path.exists(file_path):
+    def _file_has_owner(self, file_path, owner, group):
+        try:
+            st = os.stat(file_path)
+            uid = pwd.getpwnam(owner).pw_uid
+            gid = grp.getgrnam(group).gr_gid
+        except (OSError, KeyError):
+            return False
+        return st.st_uid == uid and st.st_gid == gid
+
+    def create_cinder_file(self,m_execute,m_r_helper,file_path,
+                           owner='cinder',group='cinder'):
+        """Make sure file_path exists and belongs to owner:group.
+
+        A missing file is created by a privileged touch and then chowned,
+        an existing file only gets the chown when its ownership is wrong;
+        both commands have rootwrap filters. m_execute returns once the
+        command finished, so nothing has to be polled. Provisioned paths
+        are remembered and skipped by later calls of this process.
+        """
+        if file_path in _PROVISIONED_FILES:
             return
-        cmdstr=['touch',file_path]
-        m_execute(*cmdstr, root_helper=m_r_helper, run_as_root=True)
-        anum=0
-        while 1:
-            if os.path.exists(file_path) or anum >5000:
-                cmdstr=['chown','cinder:cinder',file_path]
-                m_execute(*cmdstr, root_helper=m_r_helper, run_as_root=True)
-                break
-            else:
-                anum=anum + 1
-                continue
-                        
-        
-        
-                
-        
+        if not os.path.exists(file_path):
+            m_execute('touch', file_path,
+                      root_helper=m_r_helper, run_as_root=True)
+        if not self._file_has_owner(file_path, owner, group):
+            m_execute('chown', '%s:%s' % (owner, group), file_path,
+                      root_helper=m_r_helper, run_as_root=True)
+        _PROVISIONED_FILES.add(file_path)
@@ -0,0 +1,287 @@
+# author:sursen
+# BufferPool: fixed set of preallocated block buffers recycled by a pipeline
+# ImageToVolume: reader -> bounded queue -> writer, zero blocks become seeks
+# VolumeImageReader: file-like over a device, filled ahead by a reader thread
+# Device reads and writes go through tpool so they overlap the green side
+import io
+import os
+import stat
+import time
+import Queue
+import logging
+import threading
+from eventlet import tpool
+
+LOG = logging.getLogger(__name__)
+
+_EOF = None
+
+
+class BufferPool(object):
+    """count bytearrays of blocksize bytes, handed out and given back.
+
+    get() blocks while all buffers are in flight, which is what bounds
+    the pipeline together with the queue depth.
+    """
+    def __init__(self, blocksize, count):
+        self.blocksize = blocksize
+        self.buffers = [bytearray(blocksize) for _ in range(count)]
+        self.views = [memoryview(buf) for buf in self.buffers]
+        self._free = Queue.Queue()
+        for index in range(count):
+            self._free.put(index)
+
+    def get(self):
+        return self._free.get()
+
+    def put(self, index):
+        self._free.put(index)
+
+
+class _Pipeline(object):
+    def __init__(self, blocksize, depth):
+        self.pool = BufferPool(blocksize, depth + 2)
+        self.queue = Queue.Queue(depth)
+        self.errors = []
+
+    def _put_eof(self):
+        self.queue.put(_EOF)
+
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            if item is _EOF:
+                return
+            self.pool.put(item[0])
+
+    def _start(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+        return t
+
+
+class ImageToVolume(_Pipeline):
+    """Streams image data into a device or file.
+
+    The source is a file-like with readinto()/read() or an iterable of
+    chunks (what image_service.download() returns). Chunks are packed
+    into pool buffers by the reader thread; the writer thread writes
+    them, seeking over all-zero blocks when dst_zeroed says the target
+    already reads as zero. The writes run in tpool, the hub keeps
+    feeding the queue meanwhile. More than max_bytes of data is an error.
+    """
+    def __init__(self, blocksize=1024 * 1024, depth=8, dst_zeroed=False,
+                 max_bytes=None):
+        super(ImageToVolume, self).__init__(blocksize, depth)
+        self.blocksize = blocksize
+        self.dst_zeroed = dst_zeroed
+        self.max_bytes = max_bytes
+        self._zero = memoryview(bytearray(blocksize))
+
+    def _fill_from_file(self, src):
+        readinto = getattr(src, 'readinto', None)
+        while not self.errors:
+            index = self.pool.get()
+            view = self.pool.views[index]
+            got = 0
+            while got < self.blocksize:
+                if readinto is not None:
+                    n = readinto(view[got:])
+                else:
+                    data = src.read(self.blocksize - got)
+                    n = len(data)
+                    view[got:got + n] = data
+                if not n:
+                    break
+                got += n
+            if got:
+                self.queue.put((index, got))
+            else:
+                self.pool.put(index)
+            if got < self.blocksize:
+                return
+
+    def _fill_from_chunks(self, chunks):
+        index, got = None, 0
+        for chunk in chunks:
+            if self.errors:
+                return
+            chunk = memoryview(chunk)
+            offset = 0
+            while offset < len(chunk):
+                if index is None:
+                    index, got = self.pool.get(), 0
+                n = min(len(chunk) - offset, self.blocksize - got)
+                self.pool.views[index][got:got + n] = chunk[offset:offset + n]
+                got += n
+                offset += n
+                if got == self.blocksize:
+                    self.queue.put((index, got))
+                    index = None
+        if index is not None:
+            self.queue.put((index, got))
+
+    def _reader(self, src):
+        try:
+            if hasattr(src, 'read'):
+                self._fill_from_file(src)
+            else:
+                self._fill_from_chunks(src)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self._put_eof()
+
+    @staticmethod
+    def _write_all(fd, view):
+        written = 0
+        while written < len(view):
+            written += os.write(fd, view[written:])
+
+    def _writer(self, fd, stats):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _EOF:
+                    return
+                (index, n) = item
+                view = self.pool.views[index]
+                try:
+                    if self.errors:
+                        continue
+                    if self.max_bytes is not None and \
+                            stats['bytes'] + n > self.max_bytes:
+                        raise IOError('image data exceeds the %d bytes of '
+                                      '%s' % (self.max_bytes, stats['path']))
+                    if self.dst_zeroed and view[:n] == self._zero[:n]:
+                        os.lseek(fd, n, os.SEEK_CUR)
+                        stats['skipped'] += n
+                    else:
+                        tpool.execute(self._write_all, fd, view[:n])
+                        stats['written'] += n
+                    stats['bytes'] += n
+                finally:
+                    # the buffer goes back whether it was written or not
+                    self.pool.put(index)
+        except Exception as e:
+            self.errors.append(e)
+            # keep draining so the reader never blocks on the queue or pool
+            self._drain()
+
+    def copy(self, src, dst_path):
+        """Copy src to dst_path, returns bytes/written/skipped/seconds/mbps."""
+        stats = {'bytes': 0, 'written': 0, 'skipped': 0, 'path': dst_path}
+        start = time.time()
+        fd = os.open(dst_path, os.O_WRONLY)
+        try:
+            writer = self._start(self._writer, fd, stats)
+            reader = self._start(self._reader, src)
+            reader.join()
+            writer.join()
+            if self.errors:
+                raise self.errors[0]
+            # a trailing seek leaves a regular file short
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                if os.fstat(fd).st_size < stats['bytes']:
+                    os.ftruncate(fd, stats['bytes'])
+            tpool.execute(os.fsync, fd)
+        finally:
+            os.close(fd)
+        stats['seconds'] = max(time.time() - start, 1e-6)
+        stats['mbps'] = stats['bytes'] / stats['seconds'] / (1024 * 1024)
+        LOG.info('Wrote image to %s: %d bytes, %d skipped as zero, '
+                 '%.1f MB/s' % (dst_path, stats['bytes'], stats['skipped'],
+                                stats['mbps']))
+        return stats
+
+
+class VolumeImageReader(_Pipeline):
+    """File-like reading a device through buffers filled ahead of time.
+
+    Handed to image_service.update() so the upload of one block overlaps
+    the disk read of the next ones, which runs in tpool.
+    """
+    def __init__(self, path, blocksize=1024 * 1024, depth=8):
+        super(VolumeImageReader, self).__init__(blocksize, depth)
+        self.name = path
+        self.blocksize = blocksize
+        self._file = io.FileIO(path, 'r')
+        self._current = None
+        self._offset = 0
+        self._eof = False
+        self._stop = False
+        self._thread = self._start(self._reader)
+
+    def _reader(self):
+        try:
+            while not self._stop:
+                index = self.pool.get()
+                view = self.pool.views[index]
+                got = 0
+                while got < self.blocksize:
+                    n = tpool.execute(self._file.readinto, view[got:])
+                    if not n:
+                        break
+                    got += n
+                if not got:
+                    self.pool.put(index)
+                    return
+                self.queue.put((index, got))
+                if got < self.blocksize:
+                    return
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self._put_eof()
+
+    def _next_block(self):
+        if self._current is not None:
+            self.pool.put(self._current[0])
+            self._current = None
+        item = self.queue.get()
+        if item is _EOF:
+            self._eof = True
+            if self.errors:
+                raise self.errors[0]
+            return False
+        self._current = item
+        self._offset = 0
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0 and not self._eof:
+            if self._current is None or self._offset == self._current[1]:
+                if not self._next_block():
+                    break
+            (index, n) = self._current
+            take = n - self._offset
+            if size > 0:
+                take = min(take, size)
+                size -= take
+            view = self.pool.views[index]
+            parts.append(view[self._offset:self._offset + take].tobytes())
+            self._offset += take
+        return b''.join(parts)
+
+    def close(self):
+        if self._file is None:
+            return
+        # stop the reader and release whatever it still has queued
+        self._stop = True
+        if self._current is not None:
+            self.pool.put(self._current[0])
+            self._current = None
+        if not self._eof:
+            self._drain()
+            self._eof = True
+        self._thread.join()
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,10 +1,274 @@
 import os
+import json
+import time
+import socket
+import sqlite3
+import threading
 from cinder.volume.drivers.sursen import common
 from cinder.openstack.common import log as logging
+from cinder.openstack.common import processutils as putils
 LOG = logging.getLogger(__name__)
 
+
+class InitiatorRegistry(object):
+    """volume <-> initiator pairs in sqlite, indexed in both directions.
+
+    A volume may have several initiators (multi-attach). Lookups by volume
+    use the primary key, lookups by initiator use a secondary index, so
+    both stay O(log n) however many volumes are recorded.
+    """
+    def __init__(self, dbpath):
+        if dbpath is None:
+            raise NameError('InitiatorRegistry init error')
+        self.dbpath = dbpath
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(dbpath, timeout=30,
+                                    check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS vol_init ('
+                          'volume TEXT NOT NULL, '
+                          'initiator TEXT NOT NULL, '
+                          'PRIMARY KEY (volume, initiator))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS vol_init_initiator '
+                          'ON vol_init (initiator, volume)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                          'key TEXT PRIMARY KEY, value TEXT)')
+
+    def _write(self, statements):
+        # one IMMEDIATE transaction per call, other processes wait on it
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, rows in statements:
+                    cur.executemany(sql, rows)
+            except:
+                cur.execute('ROLLBACK')
+                raise
+            cur.execute('COMMIT')
+
+    def _query(self, sql, args):
+        with self._lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def put(self, volume, initiator):
+        self.put_many([(volume, initiator)])
+
+    def put_many(self, pairs):
+        # a new rowid also for known pairs, so the last attach sorts last
+        self._write([('INSERT OR REPLACE INTO vol_init (volume, initiator) '
+                      'VALUES (?, ?)', list(pairs))])
+
+    def delete(self, volume, initiator=None):
+        if initiator is None:
+            self.delete_many([volume])
+        else:
+            self._write([('DELETE FROM vol_init WHERE volume = ? '
+                          'AND initiator = ?', [(volume, initiator)])])
+
+    def delete_many(self, volumes):
+        self._write([('DELETE FROM vol_init WHERE volume = ?',
+                      [(v,) for v in volumes])])
+
+    def delete_pairs(self, pairs):
+        self._write([('DELETE FROM vol_init WHERE volume = ? '
+                      'AND initiator = ?', list(pairs))])
+
+    def get_initiators(self, volume):
+        """Oldest attach first."""
+        rows = self._query('SELECT initiator FROM vol_init WHERE volume = ? '
+                           'ORDER BY rowid', (volume,))
+        return [r[0] for r in rows]
+
+    def get_volumes(self, initiator):
+        rows = self._query('SELECT volume FROM vol_init WHERE initiator = ?',
+                           (initiator,))
+        return [r[0] for r in rows]
+
+    def get_meta(self, key):
+        rows = self._query('SELECT value FROM meta WHERE key = ?', (key,))
+        if len(rows) == 0:
+            return None
+        return rows[0][0]
+
+    def import_pairs(self, pairs, marker_key, marker_value):
+        """Bulk insert pairs and record marker_key in the same transaction."""
+        self._write([('INSERT OR IGNORE INTO vol_init (volume, initiator) '
+                      'VALUES (?, ?)', list(pairs)),
+                     ('INSERT OR REPLACE INTO meta (key, value) '
+                      'VALUES (?, ?)', [(marker_key, marker_value)])])
+
+
+class IdBitmap(object):
+    """Allocates integer ids in [first, first + size) in O(1).
+
+    Used ids are kept in a bitmap; released ids go to a free stack and
+    are handed out again before the high-water mark is advanced.
+    """
+    def __init__(self, size, first=0):
+        self.size = size
+        self.first = first
+        self.bits = bytearray((size + 7) // 8)
+        self._free = []
+        self._next = 0
+
+    def _test(self, i):
+        return self.bits[i >> 3] & (1 << (i & 7))
+
+    def is_used(self, n):
+        i = n - self.first
+        return 0 <= i < self.size and bool(self._test(i))
+
+    def allocate(self):
+        while self._free:
+            i = self._free.pop()
+            if not self._test(i):
+                break
+        else:
+            while self._next < self.size and self._test(self._next):
+                self._next += 1
+            if self._next >= self.size:
+                return None
+            i = self._next
+            self._next += 1
+        self.bits[i >> 3] |= 1 << (i & 7)
+        return i + self.first
+
+    def reserve(self, n):
+        i = n - self.first
+        if not 0 <= i < self.size or self._test(i):
+            return False
+        self.bits[i >> 3] |= 1 << (i & 7)
+        return True
+
+    def release(self, n):
+        i = n - self.first
+        if not 0 <= i < self.size or not self._test(i):
+            return False
+        self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xff
+        self._free.append(i)
+        return True
+
+    def rebuild_free(self):
+        """Collect the holes below the high-water mark after reserve()."""
+        used = [i for i in range(self.size) if self._test(i)]
+        self._next = used[-1] + 1 if used else 0
+        self._free = [i for i in range(self._next - 1, -1, -1)
+                      if not self._test(i)]
+
+
+class TargetAllocator(object):
+    """Host-local iSCSI target ids and LUNs, no database round trips.
+
+    Target ids come from one bitmap, LUNs from a bitmap per target. The
+    state is rebuilt from the LIO configfs tree at start-up; LIO does not
+    keep our ids, so the ones already handed to cinder come from the
+    volumes' provider_location (parse_location).
+    """
+    CONFIGFS_ROOT = '/sys/kernel/config/target/iscsi'
+
+    def __init__(self, max_targets, max_luns=256):
+        self.max_luns = max_luns
+        self._lock = threading.Lock()
+        self._tids = IdBitmap(max_targets, first=1)
+        self._luns = {}
+        # iqn -> (tid, lun)
+        self._targets = {}
+
+    @staticmethod
+    def parse_location(location):
+        """'ip:port,tid iqn lun' -> (iqn, tid, lun), None if malformed."""
+        parts = (location or '').split(' ')
+        try:
+            tid = int(parts[0].rsplit(',', 1)[1])
+            lun = int(parts[2]) if len(parts) > 2 else 0
+            return (parts[1], tid, lun)
+        except (IndexError, ValueError):
+            return None
+
+    def _configfs_luns(self, target_dir):
+        luns = []
+        for tpg in os.listdir(target_dir):
+            lun_dir = os.path.join(target_dir, tpg, 'lun')
+            if tpg.startswith('tpgt_') and os.path.isdir(lun_dir):
+                luns.extend(int(l[4:]) for l in os.listdir(lun_dir)
+                            if l.startswith('lun_') and l[4:].isdigit())
+        return luns
+
+    def _add(self, iqn, tid, luns, lun):
+        lunmap = IdBitmap(self.max_luns)
+        for n in luns:
+            lunmap.reserve(n)
+        lunmap.rebuild_free()
+        self._luns[tid] = lunmap
+        self._targets[iqn] = (tid, lun)
+
+    def load_configfs(self, prefix='', root=None, known=None):
+        """Register the targets LIO has, returns how many there are.
+
+        known maps iqn -> (tid, lun) as stored for the volume; those
+        targets keep their ids, the others get free ones.
+        """
+        root = root or self.CONFIGFS_ROOT
+        known = known or {}
+        try:
+            names = sorted(n for n in os.listdir(root) if n.startswith(prefix)
+                           and n.startswith('iqn.'))
+        except OSError:
+            return 0
+        with self._lock:
+            found = [(iqn, self._configfs_luns(os.path.join(root, iqn)))
+                     for iqn in names if iqn not in self._targets]
+            unknown = []
+            for (iqn, luns) in found:
+                (tid, lun) = known.get(iqn, (None, None))
+                if tid is None or not self._tids.reserve(tid):
+                    unknown.append((iqn, luns))
+                    continue
+                self._add(iqn, tid, luns, lun if lun in luns or not luns
+                          else min(luns))
+            # holes below the highest reserved id are handed out first
+            self._tids.rebuild_free()
+            for (iqn, luns) in unknown:
+                tid = self._tids.allocate()
+                if tid is None:
+                    LOG.warn('More LIO targets than target ids, %s skipped'
+                             % iqn)
+                    continue
+                self._add(iqn, tid, luns, min(luns) if luns else 0)
+        return len(names)
+
+    def allocate(self, iqn):
+        """(tid, lun) of iqn, allocated on first use, None when full."""
+        with self._lock:
+            if iqn in self._targets:
+                return self._targets[iqn]
+            tid = self._tids.allocate()
+            if tid is None:
+                return None
+            lunmap = IdBitmap(self.max_luns)
+            self._luns[tid] = lunmap
+            self._targets[iqn] = (tid, lunmap.allocate())
+            return self._targets[iqn]
+
+    def lookup(self, iqn):
+        return self._targets.get(iqn)
+
+    def release(self, iqn):
+        with self._lock:
+            entry = self._targets.pop(iqn, None)
+            if entry is None:
+                return False
+            self._luns.pop(entry[0], None)
+            self._tids.release(entry[0])
+            return True
+
+
 class InitiatorManager(object):
-    def __init__(self,initpath,iexecute,i_helper):
+    def __init__(self,initpath,iexecute,i_helper,flush_interval=0,
+                 registry_path=None):
         if initpath is None or iexecute is None or i_helper is None:
             raise NameError('InitiatorManager init error')
         if os.path.exists(initpath):
@@ -13,22 +277,209 @@ class InitiatorManager(object):
             icomm=common.CommonUtils()
             icomm.create_cinder_file(iexecute, i_helper, initpath)
 
-        self.inicfg=common.INIConfig(initpath)
+        # flush_interval > 0 coalesces attach/detach bursts into one write
+        self.inicfg=common.INIConfig(initpath,
+                                     write_behind=flush_interval > 0,
+                                     flush_interval=flush_interval)
         if len(self.inicfg.get_sections())==0:
             self.inicfg.create_seciton('ISCSIDEFAULT')
             self.inicfg.create_seciton('INITNAMELIST')
             self.inicfg.op_execute()
-    
+
+        # without a registry the pairs stay in the INITNAMELIST section
+        self.registry = None
+        if registry_path:
+            self.registry = InitiatorRegistry(registry_path)
+            self._migrate_ini()
+
+    def _migrate_ini(self):
+        if self.registry.get_meta('ini_migrated'):
+            return
+        pairs = []
+        if self.inicfg.cf.has_section('INITNAMELIST'):
+            for volumename in self.inicfg.get_options('INITNAMELIST'):
+                initname = self.inicfg.get('INITNAMELIST', volumename)
+                if initname:
+                    pairs.append((volumename, initname))
+        self.registry.import_pairs(pairs, 'ini_migrated', self.inicfg.path)
+        LOG.info('Migrated %d initiator records from %s to %s'
+                 % (len(pairs), self.inicfg.path, self.registry.dbpath))
+
     def add_vol_initname_pair(self,volumename,initname):
+        if self.registry is not None:
+            self.registry.put(volumename, initname)
+            return
         self.inicfg.set('INITNAMELIST',volumename,initname)
         self.inicfg.op_execute()
-    
-    def remove_vol_initname_pair(self,volumename):
+
+    def add_vol_initname_pairs(self,pairs):
+        if self.registry is not None:
+            self.registry.put_many(pairs)
+            return
+        for (volumename, initname) in pairs:
+            self.inicfg.set('INITNAMELIST',volumename,initname)
+        self.inicfg.op_execute()
+
+    def remove_vol_initname_pair(self,volumename,initname=None):
+        if self.registry is not None:
+            self.registry.delete(volumename, initname)
+            return
         self.inicfg.remove_key('INITNAMELIST',volumename)
         self.inicfg.op_execute()
-    
+
+    def remove_vol_initname_pairs(self,volumenames):
+        if self.registry is not None:
+            self.registry.delete_many(volumenames)
+            return
+        for volumename in volumenames:
+            self.inicfg.remove_key('INITNAMELIST',volumename)
+        self.inicfg.op_execute()
+
+    def remove_initname(self,initname,volumenames):
+        """Drop initname from volumenames with one write."""
+        if self.registry is not None:
+            self.registry.delete_pairs([(v, initname) for v in volumenames])
+            return
+        for volumename in volumenames:
+            if self.inicfg.get('INITNAMELIST',volumename) == initname:
+                self.inicfg.remove_key('INITNAMELIST',volumename)
+        self.inicfg.op_execute()
+
     def get_vol_initname(self,volumename):
+        if self.registry is not None:
+            initnames = self.registry.get_initiators(volumename)
+            if len(initnames) == 0:
+                return ''
+            # the latest, as the ini file keeps it
+            return initnames[-1]
         return self.inicfg.get('INITNAMELIST', volumename)
-        
-        
-        
+
+    def get_vol_initnames(self,volumename):
+        if self.registry is not None:
+            return self.registry.get_initiators(volumename)
+        initname = self.inicfg.get('INITNAMELIST', volumename)
+        if initname == '':
+            return []
+        return [initname]
+
+    def get_vols_by_initname(self,initname):
+        if self.registry is not None:
+            return self.registry.get_volumes(initname)
+        if not self.inicfg.cf.has_section('INITNAMELIST'):
+            return []
+        return [v for (v, i) in self.inicfg.cf.items('INITNAMELIST')
+                if i == initname]
+
+    def flush(self):
+        return self.inicfg.flush()
+
+
+class LioTargetClient(object):
+    """Target/ACL operations through the liodaemon unix socket.
+
+    When the daemon is not reachable each operation falls back to forking
+    cinder-rtstool; the daemon is retried after retry_interval seconds.
+    Failures are raised as ProcessExecutionError either way.
+    """
+    # client method -> daemon op, for batch()
+    _BATCH_OPS = {'remove_initiator': 'remove_acl',
+                  'delete_target': 'delete_target'}
+
+    def __init__(self, sock_path, execute, timeout=60, retry_interval=30):
+        self.sock_path = sock_path
+        self.execute = execute
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._down_since = None
+
+    def _call(self, op, **args):
+        """The daemon's response, False if it could not be reached."""
+        if not self.sock_path:
+            return False
+        if self._down_since is not None and \
+                time.time() - self._down_since < self.retry_interval:
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            try:
+                sock.connect(self.sock_path)
+            except socket.error:
+                if self._down_since is None:
+                    LOG.warn('LIO daemon at %s not reachable, using '
+                             'cinder-rtstool' % self.sock_path)
+                self._down_since = time.time()
+                return False
+            self._down_since = None
+            f = sock.makefile('rwb')
+            f.write(json.dumps({'op': op, 'args': args}) + '\n')
+            f.flush()
+            line = f.readline()
+            f.close()
+        finally:
+            sock.close()
+        if not line:
+            raise putils.ProcessExecutionError(
+                description='LIO daemon closed the connection', cmd=op)
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise putils.ProcessExecutionError(
+                description=response.get('error'), cmd=op)
+        return response
+
+    def create_target(self, name, path, userid, password, initiator_iqns=''):
+        iqns = [i.strip() for i in (initiator_iqns or '').split(',')
+                if i.strip()]
+        if self._call('create_target', name=name, path=path, userid=userid,
+                      password=password, initiator_iqns=iqns):
+            return
+        cmd = ['cinder-rtstool', 'create', path, name, userid, password]
+        if iqns:
+            cmd.append(','.join(iqns))
+        self.execute(*cmd, run_as_root=True)
+
+    def add_initiator(self, target_iqn, userid, password, initiator_iqn):
+        if self._call('add_acl', target_iqn=target_iqn,
+                      initiator_iqn=initiator_iqn, userid=userid,
+                      password=password):
+            return
+        self.execute('cinder-rtstool', 'add-initiator', target_iqn, userid,
+                     password, initiator_iqn, run_as_root=True)
+
+    def remove_initiator(self, target_iqn, initiator_iqn):
+        if self._call('remove_acl', target_iqn=target_iqn,
+                      initiator_iqn=initiator_iqn):
+            return
+        self.execute('cinder-rtstool', 'delete-initiator', target_iqn,
+                     initiator_iqn, run_as_root=True)
+
+    def delete_target(self, name):
+        if self._call('delete_target', name=name):
+            return
+        self.execute('cinder-rtstool', 'delete', name, run_as_root=True)
+
+    def save(self):
+        if self._call('save'):
+            return
+        self.execute('cinder-rtstool', 'save', run_as_root=True)
+
+    def batch(self, ops):
+        """Apply [(method name, kwargs)] of remove_initiator/delete_target.
+
+        The daemon gets them in one request, cinder-rtstool one process
+        each. Returns {index in ops: error} of the ones that failed.
+        """
+        ops = list(ops)
+        response = self._call('batch', ops=[[self._BATCH_OPS[name], args]
+                                            for (name, args) in ops])
+        if response:
+            return dict((int(index), putils.ProcessExecutionError(
+                description=error, cmd=ops[int(index)][0]))
+                for (index, error) in response.get('failed', {}).items())
+        failed = {}
+        for (index, (name, args)) in enumerate(ops):
+            try:
+                getattr(self, name)(**args)
+            except putils.ProcessExecutionError as e:
+                failed[index] = e
+        return failed
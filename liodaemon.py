@@ -0,0 +1,260 @@
+# author:sursen
+# LioTargetDaemon: privileged helper holding the LIO (rtslib) tree in
+# memory, driven by the sursen driver over a local unix socket.
+#
+# run as root, e.g. from a systemd unit:
+#   python -m cinder.volume.drivers.sursen.liodaemon /var/lib/cinder/sur-lio.sock
+#
+# protocol: one json object per line in each direction
+#   -> {"op": "add_acl", "args": {...}}
+#   <- {"ok": true} / {"ok": false, "error": "..."}
+#   -> {"op": "batch", "args": {"ops": [["remove_acl", {...}], ...]}}
+#   <- {"ok": true, "failed": {"<index>": "..."}}
+import os
+import grp
+import sys
+import json
+import time
+import Queue
+import socket
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+class LioTargetDaemon(object):
+    """Applies target/ACL operations to an in-memory rtslib tree.
+
+    Requests arriving while a batch is applied are queued and applied
+    together as the next batch. The config is saved at most once every
+    save_delay seconds after changes, or immediately on a "save" request,
+    always by the applier thread between two batches so a save never
+    sees a half-applied one.
+    """
+    def __init__(self, sock_path, save_delay=2.0, portal_port=3260,
+                 group='cinder'):
+        import rtslib
+        self.rtslib = rtslib
+        self.sock_path = sock_path
+        self.group = group
+        self.save_delay = save_delay
+        self.portal_port = portal_port
+        self.root = rtslib.root.RTSRoot()
+        self.iscsi = rtslib.FabricModule('iscsi')
+        self._requests = Queue.Queue()
+        # time the pending changes are due to be saved, None when clean;
+        # only the applier thread touches it
+        self._save_due = None
+        # iqn -> tpg, built once instead of walking configfs per request
+        self.tpgs = {}
+        for target in self.root.targets:
+            for tpg in target.tpgs:
+                self.tpgs[target.wwn] = tpg
+                break
+
+    def _local_initiator(self):
+        # cinder-rtstool create also lets the local host log in
+        try:
+            with open('/etc/iscsi/initiatorname.iscsi', 'r') as f:
+                for line in f:
+                    if 'InitiatorName' in line:
+                        return line[line.index('=') + 1:].strip()
+        except IOError:
+            pass
+        return None
+
+    def _create_target(self, name, path, userid, password,
+                       initiator_iqns=None):
+        if name in self.tpgs:
+            return
+        rtslib = self.rtslib
+        initiator_iqns = list(initiator_iqns or [])
+        local_iqn = self._local_initiator()
+        if local_iqn and local_iqn not in initiator_iqns:
+            initiator_iqns.insert(0, local_iqn)
+        so_new = rtslib.BlockStorageObject(name=name, dev=path)
+        target_new = rtslib.Target(self.iscsi, name, 'create')
+        tpg_new = rtslib.TPG(target_new, mode='create')
+        tpg_new.set_attribute('authentication', '1')
+        lun_new = rtslib.LUN(tpg_new, storage_object=so_new)
+        for iqn in initiator_iqns:
+            acl_new = rtslib.NodeACL(tpg_new, iqn, mode='create')
+            acl_new.chap_userid = userid
+            acl_new.chap_password = password
+            rtslib.MappedLUN(acl_new, lun_new.lun, lun_new.lun)
+        tpg_new.enable = 1
+        rtslib.NetworkPortal(tpg_new, '0.0.0.0', self.portal_port, mode='any')
+        try:
+            rtslib.NetworkPortal(tpg_new, '::0', self.portal_port, mode='any')
+        except rtslib.utils.RTSLibError:
+            pass
+        self.tpgs[name] = tpg_new
+
+    def _add_acl(self, target_iqn, initiator_iqn, userid, password):
+        tpg = self.tpgs.get(target_iqn)
+        if tpg is None:
+            raise ValueError('Could not find target %s' % target_iqn)
+        for acl in tpg.node_acls:
+            if acl.node_wwn == initiator_iqn:
+                return
+        acl_new = self.rtslib.NodeACL(tpg, initiator_iqn, mode='create')
+        acl_new.chap_userid = userid
+        acl_new.chap_password = password
+        self.rtslib.MappedLUN(acl_new, 0, tpg_lun=0)
+
+    def _remove_acl(self, target_iqn, initiator_iqn):
+        tpg = self.tpgs.get(target_iqn)
+        if tpg is None:
+            return
+        for acl in tpg.node_acls:
+            if acl.node_wwn == initiator_iqn:
+                acl.delete()
+
+    def _delete_target(self, name):
+        tpg = self.tpgs.pop(name, None)
+        if tpg is not None:
+            tpg.parent_target.delete()
+        for so in self.root.storage_objects:
+            if so.name == name:
+                so.delete()
+                break
+
+    def _save(self):
+        if self._save_due is None:
+            return
+        self._save_due = None
+        if hasattr(self.root, 'save_to_file'):
+            self.root.save_to_file()
+
+    def _mark_dirty(self):
+        if self._save_due is None:
+            self._save_due = time.time() + self.save_delay
+
+    def _handler(self, op):
+        handler = {'create_target': self._create_target,
+                   'add_acl': self._add_acl,
+                   'remove_acl': self._remove_acl,
+                   'delete_target': self._delete_target}.get(op)
+        if handler is None:
+            raise ValueError('unknown op %s' % op)
+        return handler
+
+    def _batch(self, ops):
+        # every op is tried, failures are reported by index
+        failed = {}
+        for (index, (op, args)) in enumerate(ops):
+            try:
+                self._handler(op)(**args)
+            except Exception as e:
+                LOG.exception('LIO op %s of batch failed', op)
+                failed[str(index)] = str(e)
+        return {'failed': failed}
+
+    def _apply(self, op, args):
+        """Extra fields of the response, if any."""
+        if op == 'save':
+            self._save()
+            return None
+        if op == 'batch':
+            result = self._batch(args.get('ops', []))
+        else:
+            result = self._handler(op)(**args)
+        self._mark_dirty()
+        return result
+
+    def _next_request(self):
+        # waits no longer than until the pending save is due, then saves
+        while True:
+            if self._save_due is None:
+                return self._requests.get()
+            remaining = self._save_due - time.time()
+            if remaining > 0:
+                try:
+                    return self._requests.get(timeout=remaining)
+                except Queue.Empty:
+                    pass
+            try:
+                self._save()
+            except Exception:
+                LOG.exception('Failed to save the LIO configuration')
+
+    def _apply_loop(self):
+        while True:
+            batch = [self._next_request()]
+            while True:
+                try:
+                    batch.append(self._requests.get_nowait())
+                except Queue.Empty:
+                    break
+            for (op, args, reply) in batch:
+                try:
+                    response = {'ok': True}
+                    response.update(self._apply(op, args) or {})
+                    reply.append(response)
+                except Exception as e:
+                    LOG.exception('LIO op %s failed', op)
+                    reply.append({'ok': False, 'error': str(e)})
+                reply[0].set()
+
+    def _serve_conn(self, conn):
+        f = conn.makefile('rwb')
+        try:
+            for line in f:
+                try:
+                    request = json.loads(line)
+                    op, args = request['op'], request.get('args', {})
+                except (ValueError, KeyError, TypeError) as e:
+                    response = {'ok': False, 'error': 'bad request: %s' % e}
+                else:
+                    reply = [threading.Event()]
+                    self._requests.put((op, args, reply))
+                    reply[0].wait()
+                    response = reply[1]
+                f.write(json.dumps(response) + '\n')
+                f.flush()
+        finally:
+            f.close()
+            conn.close()
+
+    def serve_forever(self):
+        if os.path.exists(self.sock_path):
+            os.unlink(self.sock_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.sock_path)
+        os.chmod(self.sock_path, 0o660)
+        try:
+            os.chown(self.sock_path, -1, grp.getgrnam(self.group).gr_gid)
+        except KeyError:
+            LOG.warn('Group %s not found, socket left to root', self.group)
+        server.listen(128)
+        applier = threading.Thread(target=self._apply_loop)
+        applier.daemon = True
+        applier.start()
+        LOG.info('LIO target daemon listening on %s', self.sock_path)
+        try:
+            while True:
+                (conn, _) = server.accept()
+                t = threading.Thread(target=self._serve_conn, args=(conn,))
+                t.daemon = True
+                t.start()
+        finally:
+            self._save()
+            server.close()
+
+
+def main(argv=None):
+    argv = argv or sys.argv[1:]
+    if len(argv) < 1:
+        sys.stderr.write('usage: liodaemon SOCKET_PATH [SAVE_DELAY]\n')
+        return 1
+    logging.basicConfig(level=logging.INFO)
+    save_delay = 2.0
+    if len(argv) > 1:
+        save_delay = float(argv[1])
+    LioTargetDaemon(argv[0], save_delay=save_delay).serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
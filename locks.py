@@ -0,0 +1,137 @@
+# author:sursen
+# HostLock: one lock for the threads (greenthreads) of this process and
+#           the other cinder-volume processes of the host (flock)
+# LockManager: striped per-volume HostLocks and named shared HostLocks,
+#              with wait time accounting
+import os
+import time
+import zlib
+import errno
+import fcntl
+import threading
+import contextlib
+from cinder.volume.drivers.sursen import metrics
+
+
+class HostLock(object):
+    """threading lock + flock on path, never held across processes twice.
+
+    The flock is polled with LOCK_NB and short sleeps, so a greenthread
+    waiting on another process yields to the hub instead of blocking it.
+    Not reentrant.
+    """
+    def __init__(self, path, poll_min=0.001, poll_max=0.05):
+        self.path = path
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def _flock(self):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        delay = self.poll_min
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, self.poll_max)
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            self._flock()
+        except:
+            self._lock.release()
+            raise
+
+    def release(self):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+
+class LockManager(object):
+    """Per-volume locks spread over stripes, plus named shared locks.
+
+    Operations on one volume are ordered, operations on volumes of
+    different stripes run in parallel. Shared locks ('targets',
+    'initiators', ...) guard host-wide state and are meant to be held
+    briefly, inside a volume lock and never the other way around.
+    """
+    def __init__(self, lock_dir, stripes=64):
+        if not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir)
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        # name -> [acquisitions, total wait s, max wait s]
+        self._waits = {}
+
+    def _get(self, name):
+        with self._locks_lock:
+            lock = self._locks.get(name)
+            if lock is None:
+                lock = self._locks[name] = HostLock(
+                    os.path.join(self.lock_dir, 'sur-%s.lock' % name))
+            return lock
+
+    def stripe_of(self, volume_id):
+        return (zlib.crc32(str(volume_id).encode('utf-8')) & 0xffffffff) \
+            % self.stripes
+
+    @contextlib.contextmanager
+    def _hold(self, name, tag):
+        lock = self._get(name)
+        start = time.time()
+        lock.acquire()
+        waited = time.time() - start
+        with self._locks_lock:
+            stat = self._waits.setdefault(tag, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += waited
+            if waited > stat[2]:
+                stat[2] = waited
+        if metrics.REGISTRY.enabled:
+            metrics.REGISTRY.observe('lock_wait', waited, tag)
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def volume(self, volume_id):
+        """with locks.volume(volume['id']): ..."""
+        return self._hold('volume-%d' % self.stripe_of(volume_id), 'volume')
+
+    @contextlib.contextmanager
+    def volumes(self, volume_ids):
+        """The locks of many volumes, taken in stripe order."""
+        held = []
+        try:
+            for stripe in sorted(set(self.stripe_of(v) for v in volume_ids)):
+                hold = self._hold('volume-%d' % stripe, 'volume')
+                hold.__enter__()
+                held.append(hold)
+            yield
+        finally:
+            for hold in reversed(held):
+                hold.__exit__(None, None, None)
+
+    def shared(self, name):
+        """with locks.shared('targets'): ..."""
+        return self._hold(name, name)
+
+    def stats(self):
+        """{lock kind: {'acquired', 'wait_total', 'wait_max'}} in seconds."""
+        with self._locks_lock:
+            waits = dict((tag, tuple(stat))
+                         for (tag, stat) in self._waits.items())
+        return dict((tag, {'acquired': n, 'wait_total': total,
+                           'wait_max': longest})
+                    for (tag, (n, total, longest)) in waits.items())
@@ -0,0 +1,277 @@
+# author:sursen
+# Histogram: latency counts in fixed exponential buckets
+# MetricsRegistry: per (operation, tag) histograms plus the slowest calls,
+#                  dumped as prometheus text or json
+# timed / timed_execute: instrumentation wrappers, a flag test when disabled
+# mask_argv: argv with CHAP credentials and passwords hidden
+import os
+import json
+import time
+import heapq
+import bisect
+import logging
+import tempfile
+import functools
+import threading
+
+LOG = logging.getLogger(__name__)
+
+try:
+    from cinder.openstack.common.strutils import mask_password
+except ImportError:
+    def mask_password(message, secret='***'):
+        return message
+
+# argv positions of CHAP credentials, by (command, subcommand)
+_SECRET_ARGS = {('cinder-rtstool', 'create'): (4, 5),
+                ('cinder-rtstool', 'add-initiator'): (3, 4)}
+
+# 100us .. ~52s, doubling
+BUCKETS = tuple(0.0001 * 2 ** i for i in range(20))
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for (index, n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return self.max
+
+
+class MetricsRegistry(object):
+    """Histograms keyed by (operation, tag), e.g. ('execute', 'zfs').
+
+    Nothing is recorded while enabled is False; the wrappers below test
+    the flag before taking any timestamp. The registry is shared by all
+    the backends of the process, see register_backend.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.slow_calls = 0
+        self._backends = {}
+        self.histograms = {}
+        self.errors = {}
+        self._slowest = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def configure(self, enabled, slow_calls=0):
+        self.enabled = bool(enabled)
+        self.slow_calls = slow_calls or 0
+
+    def register_backend(self, backend, enabled, slow_calls=0):
+        """Record one backend's settings, then apply those of all.
+
+        Recording is on if any backend enables it, with the largest
+        slow_calls of those, whatever order the drivers start in.
+        """
+        with self._lock:
+            self._backends[backend] = (bool(enabled), slow_calls or 0)
+            wanted = [n for (on, n) in self._backends.values() if on]
+        self.configure(bool(wanted), max(wanted) if wanted else 0)
+
+    def observe(self, name, seconds, tag='', argv=None, error=False):
+        key = (name, tag)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(seconds)
+            if error:
+                self.errors[key] = self.errors.get(key, 0) + 1
+            if self.slow_calls:
+                self._seq += 1
+                if len(self._slowest) < self.slow_calls:
+                    heapq.heappush(self._slowest, (seconds, self._seq, name,
+                                                   tag, mask_argv(argv)))
+                elif seconds > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, (seconds, self._seq,
+                                                      name, tag,
+                                                      mask_argv(argv)))
+
+    def slowest(self):
+        with self._lock:
+            return sorted(self._slowest, reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.errors = {}
+            self._slowest = []
+
+    def log_slowest(self):
+        for (seconds, _, name, tag, argv) in self.slowest():
+            LOG.info('slow %s %s: %.3fs %s'
+                     % (name, tag, seconds, ' '.join(_argv_list(argv))))
+
+    def to_dict(self):
+        with self._lock:
+            items = sorted(self.histograms.items())
+            errors = dict(self.errors)
+        result = []
+        for ((name, tag), hist) in items:
+            result.append({'op': name, 'tag': tag, 'count': hist.count,
+                           'errors': errors.get((name, tag), 0),
+                           'sum': hist.sum, 'max': hist.max,
+                           'p50': hist.quantile(0.5),
+                           'p99': hist.quantile(0.99),
+                           'buckets': list(zip(BUCKETS, hist.counts))})
+        return {'operations': result,
+                'slowest': [{'op': name, 'tag': tag, 'seconds': seconds,
+                             'argv': _argv_list(argv)}
+                            for (seconds, _, name, tag, argv)
+                            in self.slowest()]}
+
+    def to_prometheus(self):
+        with self._lock:
+            items = sorted(self.histograms.items())
+            errors = dict(self.errors)
+        lines = ['# TYPE sursen_op_seconds histogram',
+                 '# TYPE sursen_op_errors_total counter']
+        for ((name, tag), hist) in items:
+            labels = 'op="%s",tag="%s"' % (name, tag.replace('"', ''))
+            seen = 0
+            for (bound, n) in zip(BUCKETS, hist.counts):
+                seen += n
+                lines.append('sursen_op_seconds_bucket{%s,le="%g"} %d'
+                             % (labels, bound, seen))
+            lines.append('sursen_op_seconds_bucket{%s,le="+Inf"} %d'
+                         % (labels, hist.count))
+            lines.append('sursen_op_seconds_sum{%s} %f' % (labels, hist.sum))
+            lines.append('sursen_op_seconds_count{%s} %d'
+                         % (labels, hist.count))
+            lines.append('sursen_op_errors_total{%s} %d'
+                         % (labels, errors.get((name, tag), 0)))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, fmt='prometheus'):
+        """Write all metrics to path atomically, json or prometheus text."""
+        if fmt == 'json':
+            data = json.dumps(self.to_dict(), indent=1)
+        else:
+            data = self.to_prometheus()
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        (fd, tmppath) = tempfile.mkstemp(dir=dirname, prefix='.metrics.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.rename(tmppath, path)
+        except:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+        if self.slow_calls:
+            self.log_slowest()
+
+
+REGISTRY = MetricsRegistry()
+
+
+def _argv_list(argv):
+    # shell strings from SysCmdExecute stay one item
+    if argv is None:
+        return []
+    if not isinstance(argv, (list, tuple)):
+        return [str(argv)]
+    return [str(a) for a in argv]
+
+
+def mask_argv(argv):
+    """argv as a list with secrets replaced by '***', safe to log."""
+    argv = _argv_list(argv)
+    if not argv:
+        return argv
+    key = (os.path.basename(argv[0]), argv[1] if len(argv) > 1 else '')
+    hidden = _SECRET_ARGS.get(key, ())
+    return ['***' if index in hidden else mask_password(arg)
+            for (index, arg) in enumerate(argv)]
+
+
+def command_tag(cmd):
+    """'zfs list ...' / ['zfs', 'list'] -> 'zfs'."""
+    if isinstance(cmd, (list, tuple)):
+        cmd = cmd[0] if cmd else ''
+    words = str(cmd).split()
+    return os.path.basename(words[0]) if words else ''
+
+
+def record(name):
+    """Time a block: with record('op') as r: r.tag = ...; r.argv = ..."""
+    return _Record(name)
+
+
+class _Record(object):
+    def __init__(self, name):
+        self.name = name
+        self.tag = ''
+        self.argv = None
+
+    def __enter__(self):
+        self.start = time.time() if REGISTRY.enabled else None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.start is not None:
+            REGISTRY.observe(self.name, time.time() - self.start, self.tag,
+                             self.argv, error=exc_type is not None)
+
+
+def timed(name):
+    """Decorator recording the latency of every call as name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not REGISTRY.enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            error = True
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                REGISTRY.observe(name, time.time() - start, error=error)
+        return wrapper
+    return decorator
+
+
+def timed_execute(execute, name='execute'):
+    """Wrap a utils.execute style callable, tagged by command name."""
+    if getattr(execute, '_sur_timed', False):
+        return execute
+
+    def wrapper(*cmd, **kwargs):
+        if not REGISTRY.enabled:
+            return execute(*cmd, **kwargs)
+        start = time.time()
+        error = True
+        try:
+            result = execute(*cmd, **kwargs)
+            error = False
+            return result
+        finally:
+            REGISTRY.observe(name, time.time() - start, command_tag(cmd),
+                             cmd, error=error)
+    wrapper._sur_timed = True
+    return wrapper
@@ -1,16 +1,35 @@
+import os
+import time
 import socket
+import hashlib
+from eventlet import tpool
 from cinder import utils
+from cinder import context as ccontext
 from oslo.config import cfg
 from cinder import exception
 from cinder.volume import driver
-from cinder.brick.iscsi import iscsi
 from cinder.volume import utils as cutils
 from cinder.volume.drivers import remotefs
-from cinder.brick import exception as iexception
 from cinder.openstack.common import log as logging
+from cinder.volume.drivers.sursen import common
 from cinder.volume.drivers.sursen import iscsipatch
+from cinder.volume.drivers.sursen import metrics
+from cinder.openstack.common import excutils
 from cinder.openstack.common import processutils as putils
 
+# only needed once volumes are exported, copied or wiped; registering the
+# options and building the driver does not import them
+greenpool = common.LazyModule('eventlet.greenpool')
+loopingcall = common.LazyModule('cinder.openstack.common.loopingcall')
+iexception = common.LazyModule('cinder.brick.exception')
+volcopy = common.LazyModule('cinder.volume.drivers.sursen.volcopy')
+volwipe = common.LazyModule('cinder.volume.drivers.sursen.volwipe')
+blocktrack = common.LazyModule('cinder.volume.drivers.sursen.blocktrack')
+reflink = common.LazyModule('cinder.volume.drivers.sursen.reflink')
+imagexfer = common.LazyModule('cinder.volume.drivers.sursen.imagexfer')
+zfsops = common.LazyModule('cinder.volume.drivers.sursen.zfsops')
+locks = common.LazyModule('cinder.volume.drivers.sursen.locks')
+
 
 LOG = logging.getLogger(__name__)
 
@@ -24,6 +43,10 @@ volume_opts = [
     cfg.IntOpt('iscsi_num_targets',
                default=100,
                help='The maximum number of iSCSI target IDs per host'),
+    cfg.IntOpt('max_iscsi_targets',
+               default=65535,
+               help='Number of target ids the local target allocator '
+                    'hands out'),
     cfg.StrOpt('iscsi_target_prefix',
                default='iqn.2010-10.org.openstack:',
                help='Prefix for iSCSI volumes'),
@@ -33,6 +56,32 @@ volume_opts = [
     cfg.StrOpt('initiator_path',
                default='/etc/cinder/initiatortable.ini',
                help='The record for host initiatorname'),
+    cfg.FloatOpt('initiator_flush_interval',
+                 default=0,
+                 help='Seconds to coalesce initiator table changes before '
+                      'writing them, changes of that window are lost on a '
+                      'crash. 0 => write on every change'),
+    cfg.StrOpt('initiator_registry_path',
+               default=None,
+               help='Indexed sqlite store for volume/initiator pairs, '
+                    'migrated from initiator_path on first use; the ini '
+                    'file is not written any more once it is set. Empty '
+                    'keeps the pairs in initiator_path'),
+    cfg.StrOpt('lio_daemon_socket',
+               default='$state_path/sur-lio.sock',
+               help='Unix socket of the sursen LIO target daemon. When it '
+                    'is not reachable cinder-rtstool is run instead'),
+    cfg.IntOpt('ensure_export_concurrency',
+               default=16,
+               help='Number of volumes exported at the same time by '
+                    'ensure_exports'),
+    cfg.IntOpt('chap_cache_size',
+               default=4096,
+               help='Number of target CHAP credentials cached in memory'),
+    cfg.IntOpt('volume_stats_interval',
+               default=60,
+               help='Seconds between two background collections of the '
+                    'volume stats reported to the scheduler'),
     cfg.IntOpt('iscsi_port',
                default=3260,
                help='The port that the iSCSI daemon is listening on'),
@@ -58,6 +107,15 @@ volume_opts = [
     cfg.IntOpt('volume_clear_size',
                default=0,
                help='Size in MiB to wipe at start of old volumes. 0 => all'),
+    cfg.StrOpt('zvol_clear',
+               default='none',
+               help='Method used to wipe zvols before they are destroyed '
+                    '(none, zero, shred). A destroyed zvol never shows up '
+                    'in another dataset, a new zvol reads as zero, and '
+                    'under copy-on-write the wipe writes new blocks rather '
+                    'than overwriting the old ones, so it only serves '
+                    'policies that demand a wipe before the space is '
+                    'released; it does not scrub the disks'),
     cfg.StrOpt('volume_clear_ionice',
                default=None,
                help='The flag to pass to ionice to alter the i/o priority '
@@ -118,42 +176,249 @@ volume_opts = [
     cfg.IntOpt('disk_copy_speed',
                default=40,
                help='disk copy speed'),
+    cfg.StrOpt('migration_checkpoint_dir',
+               default='$state_path/migrations',
+               help='Directory of the checkpoints that let an interrupted '
+                    'volume migration resume, empty copies volumes in one '
+                    'pass without checkpoints'),
+    cfg.IntOpt('migration_chunk_size',
+               default=64,
+               help='Size in MiB of the chunks a migration copies and '
+                    'checkpoints'),
+    cfg.IntOpt('migration_checkpoint_max_age',
+               default=7 * 24 * 3600,
+               help='Seconds the checkpoint of a failed migration is kept '
+                    'for a later retry to resume from'),
+    cfg.IntOpt('migration_workers',
+               default=4,
+               help='Number of chunks a migration copies in parallel'),
+    cfg.IntOpt('image_xfer_queue_depth',
+               default=8,
+               help='Blocks buffered between reading and writing during '
+                    'image to volume and volume to image transfers'),
+    cfg.BoolOpt('metrics_enabled',
+                default=False,
+                help='Record latency histograms of exports, attaches, '
+                     'commands, initiator table and device lookups'),
+    cfg.StrOpt('metrics_dump_path',
+               default='$state_path/sur-metrics.prom',
+               help='File the metrics are written to'),
+    cfg.StrOpt('metrics_dump_format',
+               default='prometheus',
+               help='prometheus or json'),
+    cfg.IntOpt('metrics_slow_calls',
+               default=0,
+               help='Log the N slowest calls with their argv on every dump, '
+                    '0 disables it'),
+    cfg.StrOpt('zfspool',
+               default=None,
+               help='ZFS pool or dataset the volumes are created in'),
+    cfg.FloatOpt('zfs_batch_window',
+                 default=0.05,
+                 help='Seconds snapshot and destroy requests are collected '
+                      'before they run as one zfs command'),
+    cfg.BoolOpt('zfs_channel_programs',
+                default=False,
+                help='Destroy batches with one zfs channel program, needs '
+                     'ZFS on Linux 0.8 or later'),
+    cfg.FloatOpt('zfs_list_ttl',
+                 default=5.0,
+                 help='Seconds a zfs list of the pool is reused for'),
+    cfg.StrOpt('sur_shares_config',
+               default='/etc/cinder/sur_shares',
+               help='File with the list of shares of SurRemotefsDriver, one '
+                    'per line, optionally followed by mount options'),
+    cfg.StrOpt('sur_mount_point_base',
+               default='$state_path/mnt',
+               help='Base dir the SurRemotefsDriver shares are mounted under'),
+    cfg.StrOpt('sur_fs_type',
+               default='nfs',
+               help='Filesystem type the shares are mounted with, e.g. nfs '
+                    '(4.2 for server side clones), xfs or btrfs'),
+    cfg.StrOpt('sur_mount_options',
+               default=None,
+               help='Mount options for shares without their own'),
+    cfg.BoolOpt('sur_sparsed_volumes',
+                default=True,
+                help='Create volumes as sparse files'),
+    cfg.StrOpt('cbt_index_dir',
+               default='$state_path/cbt',
+               help='Directory of the per-volume changed-block indexes'),
+    cfg.IntOpt('cbt_chunk_size',
+               default=4,
+               help='Size in MiB of the chunks the changed-block index '
+                    'hashes'),
+    cfg.IntOpt('cbt_workers',
+               default=0,
+               help='Processes hashing a volume for the changed-block '
+                    'index, 0 means one per cpu'),
+    cfg.StrOpt('sur_lock_path',
+               default='$state_path/sur-locks',
+               help='Directory of the lock files shared by the cinder-volume '
+                    'processes of the host'),
+    cfg.IntOpt('volume_lock_stripes',
+               default=64,
+               help='Number of per-volume locks, volumes hashing to the same '
+                    'one are serialised'),
 
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(volume_opts)
+CONF.import_opt('volume_name_template', 'cinder.db')
 
 class SurIscsiVolumeDriver(driver.VolumeDriver):
+    VERSION = '1.0.0'
+
     def __init__(self, *args, **kwargs):
-        super(SurIscsiVolumeDriver, self).__init__(*args, **kwargs)
-        self.configuration.append_config_values(volume_opts)
-        self._execute = utils.execute
+        self.startup_timer = common.StartupTimer(self.__class__.__name__)
+        with self.startup_timer.phase('config'):
+            super(SurIscsiVolumeDriver, self).__init__(*args, **kwargs)
+            self.configuration.append_config_values(volume_opts)
+        metrics.REGISTRY.register_backend(
+            getattr(self.configuration, 'config_group', None) or
+            self.__class__.__name__,
+            self.configuration.safe_get('metrics_enabled'),
+            self.configuration.safe_get('metrics_slow_calls'))
+        self._execute = metrics.timed_execute(utils.execute)
         self.r_helper = utils.get_root_helper()
-        
-        self.hostname = socket.gethostname()
-        
-        self.iscsiobj = driver.ISCSIDriver(*args, **kwargs)
-        self.target_helper = self.iscsiobj.get_target_helper(self.db)
-        self.targetbase = iscsi.LioAdm(root_helper=self.r_helper,
-                              execute=self._execute)     
-        
-        self.volume_dd_bksize = self.configuration.safe_get('volume_dd_blocksize')
-        self.initiator_path=self.configuration.safe_get('initiator_path')       
-        if self.volume_dd_bksize.isdigit() is False:
-            self.volume_dd_bksize = '1M'
-        else:
-            if int(self.volume_dd_bksize) > 1000 or int(self.volume_dd_bksize) < 1024:
-                self.volume_dd_bksize = '1M'
-            else:
-                self.volume_dd_bksize = int(self.volume_dd_bksize) * 1024
-                
-        self.initiator_manager=iscsipatch.InitiatorManager(self.initiator_path,self._execute,self.r_helper)
-                
+        # kept for the lazily built ISCSIDriver
+        self._driver_args = (args, kwargs)
+        with self.startup_timer.phase('allocator'):
+            self.target_allocator = iscsipatch.TargetAllocator(
+                self.configuration.safe_get('max_iscsi_targets'))
+        # iqn -> (chap user, chap password)
+        self.chap_cache = common.LRUCache(
+            self.configuration.safe_get('chap_cache_size'))
+        self.initiator_path=self.configuration.safe_get('initiator_path')
         self._stats = {}
+        self._stats_timer = None
+        # volumes ensure_exports handled in do_setup
+        self._setup_ensured = set()
+
+    @common.lazy_property
+    def hostname(self):
+        return socket.gethostname()
+
+    @common.lazy_property
+    def iscsiobj(self):
+        (args, kwargs) = self._driver_args
+        return driver.ISCSIDriver(*args, **kwargs)
+
+    @common.lazy_property
+    def target_helper(self):
+        return self.iscsiobj.get_target_helper(self.db)
+
+    @common.lazy_property
+    def lio_client(self):
+        return iscsipatch.LioTargetClient(
+            self.configuration.safe_get('lio_daemon_socket'), self._execute)
+
+    @common.lazy_property
+    def zfs(self):
+        conf = self.configuration
+        return zfsops.ZfsOps(self._execute, conf.safe_get('zfspool'),
+                             batch_window=conf.safe_get('zfs_batch_window'),
+                             channel_programs=conf.safe_get(
+                                 'zfs_channel_programs'),
+                             list_ttl=conf.safe_get('zfs_list_ttl'))
+
+    @common.lazy_property
+    def volume_dd_bksize(self):
+        # bytes, '1M' style values and plain numbers are accepted
+        return volcopy.parse_blocksize(
+            self.configuration.safe_get('volume_dd_blocksize'))
+
+    @common.lazy_property
+    def initiator_manager(self):
+        return iscsipatch.InitiatorManager(
+            self.initiator_path, self._execute, self.r_helper,
+            flush_interval=self.configuration.safe_get('initiator_flush_interval'),
+            registry_path=self.configuration.safe_get('initiator_registry_path'))
+
+    @common.lazy_property
+    def change_tracker(self):
+        return blocktrack.ChangeTracker(
+            self.configuration.safe_get('cbt_index_dir'),
+            chunk_size=self.configuration.safe_get('cbt_chunk_size') * 1024 * 1024,
+            processes=self.configuration.safe_get('cbt_workers') or None)
+
+    @common.lazy_property
+    def lock_manager(self):
+        return locks.LockManager(
+            self.configuration.safe_get('sur_lock_path'),
+            stripes=self.configuration.safe_get('volume_lock_stripes'))
+
+    def get_lock_stats(self):
+        """Acquisitions and wait seconds per lock kind."""
+        return self.lock_manager.stats()
+
+    def get_startup_report(self):
+        """Seconds per start-up phase, lazily built collaborators included."""
+        return dict(self.startup_timer.phases)
+
+    def do_setup(self, context):
+        timer = self.startup_timer
+        host = getattr(self, 'host', None)
+        volumes = []
+        if host:
+            with timer.phase('chap_cache'):
+                volumes = self.db.volume_get_all_by_host(context, host)
+                self._cache_chap_auths(volumes)
+        # pick up the targets that already exist in LIO, with the target
+        # ids their volumes were given
+        known = {}
+        for volume in volumes:
+            location = iscsipatch.TargetAllocator.parse_location(
+                volume['provider_location'])
+            if location is not None:
+                known[location[0]] = location[1:]
+        with timer.phase('configfs'):
+            count = self.target_allocator.load_configfs(
+                self.configuration.iscsi_target_prefix, known=known)
+        LOG.info('Loaded %d existing iscsi targets from configfs' % count)
+        # the manager's ensure_export calls that follow find these done
+        exported = [v for v in volumes if v['status'] in ('available', 'in-use')]
+        with timer.phase('ensure_exports'):
+            failures = self._ensure_exports(
+                context, exported, dict((v['id'], v) for v in volumes))
+        self._setup_ensured = set(v['id'] for v in exported
+                                  if v['id'] not in failures)
+        with timer.phase('stats_timer'):
+            self._start_stats_timer()
+        LOG.info(timer.report())
+
+    def _cache_chap_auths(self, volumes):
+        prefix = self.configuration.iscsi_target_prefix
+        for volume in volumes:
+            if volume['provider_auth']:
+                auth = tuple(volume['provider_auth'].split(' ', 3)[1:])
+                self.chap_cache.put("%s%s" % (prefix, volume['name']), auth)
+
+    def _get_chap_auth(self, context, iscsi_name):
+        chap_auth = self.chap_cache.get(iscsi_name)
+        if chap_auth is not None:
+            return chap_auth
+        try:
+            chap_auth = self.target_helper._get_target_chap_auth(context, iscsi_name)
+        except:
+            chap_auth = self._get_iscsitarget_chap_auth(context, iscsi_name)
+        if chap_auth:
+            self.chap_cache.put(iscsi_name, tuple(chap_auth))
+        return chap_auth
+
+    def get_chap_cache_stats(self):
+        return self.chap_cache.stats()
 
     def set_execute(self, execute):
+        execute = metrics.timed_execute(execute)
         self._execute = execute
+        # a client built later picks up self._execute by itself
+        if 'lio_client' in self.__dict__:
+            self.lio_client.execute = execute
+        if 'zfs' in self.__dict__:
+            self.zfs.execute = execute
+            self.zfs.table.execute = execute
         return
     
     def _sizestr(self, size_in_g):
@@ -161,6 +426,253 @@ class SurIscsiVolumeDriver(driver.VolumeDriver):
             return '100Mb'
         return '%sGb' % size_in_g
     
+    def _copy_volume(self, srcstr, deststr, size_in_m, sparse=False):
+        """Copy size_in_m MiB in process, sparse if deststr reads as zero."""
+        def _report(done, total, mbps):
+            LOG.debug('Copying %s to %s: %d%%, %.1f MB/s'
+                      % (srcstr, deststr, done * 100 / max(total, 1), mbps))
+        copier = volcopy.VolumeCopier(
+            blocksize=self.volume_dd_bksize,
+            bps_limit=self._copy_bps_limit(),
+            progress_callback=_report)
+        # the copy blocks in the kernel, keep it off the eventlet hub
+        return tpool.execute(copier.copy, srcstr, deststr,
+                             size=int(size_in_m) * 1024 * 1024,
+                             dst_zeroed=sparse)
+
+    def _copy_bps_limit(self, migration=False):
+        # volume_copy_bps_limit (B/s), for a migration the tighter of it
+        # and disk_copy_speed (MB/s); 0 for no limit
+        conf = self.configuration
+        limits = [conf.safe_get('volume_copy_bps_limit') or 0]
+        if migration:
+            limits.append((conf.safe_get('disk_copy_speed') or 0) *
+                          1024 * 1024)
+        limits = [l for l in limits if l > 0]
+        return min(limits) if limits else 0
+
+    def clear_volume(self, volume, is_snapshot=False):
+        """Wipe volume before its space is given back, see zvol_clear."""
+        method = self.configuration.safe_get('zvol_clear')
+        if method == 'none':
+            return None
+        return self._clear_volume(self._get_volume_devpath(volume['name']),
+                                  volume['size'], method)
+
+    def delete_volume(self, volume):
+        """Wipe the zvol as zvol_clear says, then destroy it.
+
+        A zvol with snapshots or clones cannot be destroyed; that is
+        found out before the wipe, which would otherwise zero a volume
+        that stays in use.
+        """
+        dataset = self._zfs_dataset(volume['name'])
+        if not self.zfs.table.exists(dataset):
+            LOG.info('Volume %s not found, nothing to delete' % dataset)
+            return
+        if self.zfs.table.snapshots_of(dataset) or \
+                self.zfs.table.children(dataset):
+            raise exception.VolumeIsBusy(volume_name=volume['name'])
+        self.clear_volume(volume)
+        self.zfs.destroy(dataset)
+        # a later volume of the same name starts without a baseline
+        self.change_tracker.forget(volume['name'])
+
+    def _clear_volume(self, volume_path, size_in_g, method=None):
+        """Wipe a deleted volume as volume_clear/volume_clear_size say,
+        or with method."""
+        conf = self.configuration
+        size_in_m = conf.safe_get('volume_clear_size')
+        if not size_in_m:
+            size_in_m = int(size_in_g) * 1024
+        wiper = volwipe.VolumeWiper(
+            method=method or conf.safe_get('volume_clear'),
+            blocksize=self.volume_dd_bksize,
+            ionice=conf.safe_get('volume_clear_ionice'))
+        # the wiper's own thread does the I/O, wait for it off the hub
+        return tpool.execute(wiper.wipe, volume_path,
+                             int(size_in_m) * 1024 * 1024)
+
+    def _prune_checkpoints(self, ckpt_dir):
+        # checkpoints of migrations that failed and were never retried
+        max_age = self.configuration.safe_get('migration_checkpoint_max_age')
+        if not max_age:
+            return
+        now = time.time()
+        for name in os.listdir(ckpt_dir):
+            path = os.path.join(ckpt_dir, name)
+            try:
+                if name.endswith('.ckpt') and \
+                        now - os.path.getmtime(path) > max_age:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def _migrate_copy(self, srcstr, deststr, size_in_m, name, sparse=False):
+        """Chunked, checkpointed copy within the copy bandwidth limits.
+
+        name is the source volume: a failed run is resumed from its
+        checkpoint up to check_times_where_resume times, and so is a later
+        migration of the same volume, after a restart too (chunks already
+        on another target are copied again). The checkpoint is removed
+        once the copy succeeded; after a final failure it is kept for
+        migration_checkpoint_max_age seconds.
+        """
+        conf = self.configuration
+        ckpt_dir = conf.safe_get('migration_checkpoint_dir')
+        if not os.path.isdir(ckpt_dir):
+            os.makedirs(ckpt_dir)
+        self._prune_checkpoints(ckpt_dir)
+        migration = volcopy.ChunkedMigration(
+            srcstr, deststr, os.path.join(ckpt_dir, name + '.ckpt'),
+            int(size_in_m) * 1024 * 1024,
+            chunk_size=conf.safe_get('migration_chunk_size') * 1024 * 1024,
+            workers=conf.safe_get('migration_workers'),
+            bps_limit=self._copy_bps_limit(migration=True),
+            blocksize=self.volume_dd_bksize,
+            dst_zeroed=sparse)
+        attempts = max(conf.safe_get('check_times_where_resume'), 1)
+        for attempt in range(1, attempts + 1):
+            try:
+                # workers are OS threads, wait for them off the hub
+                copied = tpool.execute(migration.run)
+                break
+            except (IOError, OSError) as e:
+                LOG.warn('Migration %s failed (attempt %d of %d): %s'
+                         % (name, attempt, attempts, e))
+                if attempt == attempts:
+                    raise
+        migration.checkpoint.remove()
+        LOG.info('Migration %s done, %d chunks copied' % (name, copied))
+
+    def get_changed_extents(self, volume_name, device_path, size_in_g,
+                            target=None):
+        """Extents changed since the last commit_changed_extents for target.
+
+        Returns (extents, index); the whole volume is reported the first
+        time a target is seen. Pass index to commit_changed_extents with
+        the same target once the extents were backed up or re-synced.
+        Nothing in cinder calls this yet: the Icehouse backup services
+        only take full streams and migrations copy to fresh volumes, so
+        it is a hook for an incremental backup or re-sync caller.
+        """
+        return tpool.execute(self.change_tracker.diff, volume_name,
+                             device_path, int(size_in_g) * 1024 ** 3,
+                             target)
+
+    def commit_changed_extents(self, volume_name, index, target=None):
+        self.change_tracker.commit(volume_name, index, target)
+
+    def _resync_volume(self, volume_name, srcstr, deststr, size_in_g,
+                       target=None):
+        """Bring a previously synced copy up to date, changed extents only.
+
+        target names the copy, deststr by default; a copy never synced
+        from this volume gets all of it.
+        """
+        target = target or deststr
+        (extents, index) = self.get_changed_extents(volume_name, srcstr,
+                                                    size_in_g, target)
+        copied = tpool.execute(blocktrack.copy_extents, srcstr, deststr,
+                               extents, self.volume_dd_bksize)
+        self.commit_changed_extents(volume_name, index, target)
+        LOG.info('Re-synced %s: %d bytes in %d extents'
+                 % (volume_name, copied, len(extents)))
+        return copied
+
+    def copy_volume_data(self, context, src_vol, dest_vol, remote=None):
+        """Copy data from src_vol to the new dest_vol.
+
+        The resumable _migrate_copy is used unless migration_checkpoint_dir
+        is empty, then _copy_volume copies in one pass. Both skip zero
+        blocks, dest_vol is a fresh volume reading as zero.
+        """
+        properties = utils.brick_get_connector_properties()
+        dest_remote = remote in ['dest', 'both']
+        src_remote = remote in ['src', 'both']
+        dest_attach_info = self._attach_volume(context, dest_vol, properties,
+                                               remote=dest_remote)
+        try:
+            src_attach_info = self._attach_volume(context, src_vol,
+                                                  properties,
+                                                  remote=src_remote)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._detach_volume(context, dest_attach_info, dest_vol,
+                                    properties, force=True,
+                                    remote=dest_remote)
+        copy_error = True
+        size_in_m = int(src_vol['size']) * 1024
+        try:
+            if not self.configuration.safe_get('migration_checkpoint_dir'):
+                self._copy_volume(src_attach_info['device']['path'],
+                                  dest_attach_info['device']['path'],
+                                  size_in_m, sparse=True)
+            else:
+                self._migrate_copy(src_attach_info['device']['path'],
+                                   dest_attach_info['device']['path'],
+                                   size_in_m, src_vol['id'], sparse=True)
+            copy_error = False
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                LOG.error('Failed to copy volume %s to %s'
+                          % (src_vol['id'], dest_vol['id']))
+        finally:
+            self._detach_volume(context, dest_attach_info, dest_vol,
+                                properties, force=copy_error,
+                                remote=dest_remote)
+            self._detach_volume(context, src_attach_info, src_vol,
+                                properties, force=copy_error,
+                                remote=src_remote)
+
+    def copy_image_to_volume(self, context, volume, image_service, image_id):
+        """Stream raw images straight into the new volume.
+
+        Other formats still go through qemu-img in fetch_to_raw.
+        """
+        image_meta = image_service.show(context, image_id)
+        if image_meta.get('disk_format') != 'raw' or \
+                image_meta.get('container_format') not in (None, 'bare'):
+            return super(SurIscsiVolumeDriver, self).copy_image_to_volume(
+                context, volume, image_service, image_id)
+        # a raw image is as large as its data
+        capacity = int(volume['size']) * 1024 * 1024 * 1024
+        image_size = image_meta.get('virtual_size') or image_meta.get('size')
+        if image_size and int(image_size) > capacity:
+            raise exception.ImageUnacceptable(
+                image_id=image_id,
+                reason='image size %s bytes exceeds the %sG of volume %s'
+                       % (image_size, volume['size'], volume['id']))
+        properties = utils.brick_get_connector_properties()
+        attach_info = self._attach_volume(context, volume, properties)
+        try:
+            # a new zvol reads as zero, zero blocks need not be written
+            pipeline = imagexfer.ImageToVolume(
+                blocksize=self.volume_dd_bksize,
+                depth=self.configuration.safe_get('image_xfer_queue_depth'),
+                dst_zeroed=True, max_bytes=capacity)
+            pipeline.copy(image_service.download(context, image_id),
+                          attach_info['device']['path'])
+        finally:
+            self._detach_volume(context, attach_info, volume, properties)
+
+    def copy_volume_to_image(self, context, volume, image_service, image_meta):
+        """Upload raw images from a read-ahead pipeline over the volume."""
+        if image_meta.get('disk_format') != 'raw':
+            return super(SurIscsiVolumeDriver, self).copy_volume_to_image(
+                context, volume, image_service, image_meta)
+        properties = utils.brick_get_connector_properties()
+        attach_info = self._attach_volume(context, volume, properties)
+        try:
+            with imagexfer.VolumeImageReader(
+                    attach_info['device']['path'],
+                    blocksize=self.volume_dd_bksize,
+                    depth=self.configuration.safe_get(
+                        'image_xfer_queue_depth')) as reader:
+                image_service.update(context, image_meta['id'], {}, reader)
+        finally:
+            self._detach_volume(context, attach_info, volume, properties)
+
     def _escape_snapshot(self, snapshot_name):
         # Linux ZFS reserves name that starts with snapshot, so that
         # such volume name can't be created. Mangle it.
@@ -168,6 +680,33 @@ class SurIscsiVolumeDriver(driver.VolumeDriver):
             raise NameError('wrong snapshot name')
         return snapshot_name
 
+    def _zfs_dataset(self, volume_name):
+        return '%s/%s' % (self.configuration.safe_get('zfspool'), volume_name)
+
+    def _zvol_missing(self, volume_name):
+        """True only when the pool listing says the zvol does not exist."""
+        if not self.configuration.safe_get('zfspool'):
+            return False
+        try:
+            return not self.zfs.table.exists(self._zfs_dataset(volume_name))
+        except putils.ProcessExecutionError as e:
+            LOG.warn('Failed to list the zfs pool: %s' % e)
+            return False
+
+    def create_snapshot(self, snapshot):
+        """Snapshots taken at the same time share one zfs snapshot call."""
+        self.zfs.snapshot(self._zfs_dataset(snapshot['volume_name']),
+                          self._escape_snapshot(snapshot['name']))
+
+    def delete_snapshot(self, snapshot):
+        name = '%s@%s' % (self._zfs_dataset(snapshot['volume_name']),
+                          self._escape_snapshot(snapshot['name']))
+        # the cached listing saves a zfs call for snapshots already gone
+        if not self.zfs.table.exists(name):
+            LOG.info('Snapshot %s not found, nothing to delete' % name)
+            return
+        self.zfs.destroy(name)
+
     def _get_iscsitarget_chap_auth(self, context, iscsi_name):
         try: 
             # 'iscsi_name': 'iqn.2010-10.org.openstack:volume-00000001' 
@@ -179,6 +718,7 @@ class SurIscsiVolumeDriver(driver.VolumeDriver):
         except exception.NotFound: 
             LOG.debug('Failed to get CHAP auth from DB for %s', vol_id) 
 
+    @metrics.timed('create_export')
     def _create_export(self, context, volume):
         """Creates an export for a logical volume.""" 
         if volume['name'] is None:
@@ -189,31 +729,33 @@ class SurIscsiVolumeDriver(driver.VolumeDriver):
         conf = self.configuration
         iscsi_name = "%s%s" % (conf.iscsi_target_prefix,
                                volume['name'])
-        max_targets = conf.safe_get('iscsi_num_targets')
-        (iscsi_target, lun) = self.target_helper._get_target_and_lun(context,
-                                                       volume,
-                                                       max_targets)
-        try:
-            current_chap_auth = self.target_helper._get_target_chap_auth(context, iscsi_name)
-        except:
-            current_chap_auth = self._get_iscsitarget_chap_auth(context, iscsi_name)
-            pass
-                      
-        if current_chap_auth:
-            (chap_username, chap_password) = current_chap_auth
-        else:
-            chap_username = cutils.generate_username()
-            chap_password = cutils.generate_password()
-        chap_auth = self.target_helper._iscsi_authentication('IncomingUser',
-                                               chap_username,
-                                               chap_password)
-        # NOTE(jdg): For TgtAdm case iscsi_name is the ONLY param we need
-        # should clean this all up at some point in the future
-        
-        tid = self.targetbase.create_iscsi_target(iscsi_name, iscsi_target, 0,
-                                       volume_path,
-                                       chap_auth,
-                                       write_cache=conf.iscsi_write_cache)
+        with self.lock_manager.volume(volume['id']):
+            with self.lock_manager.shared('targets'):
+                existed = self.target_allocator.lookup(iscsi_name) is not None
+                target = self.target_allocator.allocate(iscsi_name)
+            if target is None:
+                raise exception.NoMoreTargets()
+            (iscsi_target, lun) = target
+            current_chap_auth = self._get_chap_auth(context, iscsi_name)
+
+            if current_chap_auth:
+                (chap_username, chap_password) = current_chap_auth
+            else:
+                chap_username = cutils.generate_username()
+                chap_password = cutils.generate_password()
+                self.chap_cache.put(iscsi_name, (chap_username, chap_password))
+
+            try:
+                self.lio_client.create_target(iscsi_name, volume_path,
+                                              chap_username, chap_password,
+                                              conf.safe_get('lio_initiator_iqns'))
+            except putils.ProcessExecutionError:
+                LOG.error('Failed to create iscsi target for volume %s' % volume['id'])
+                if not existed:
+                    with self.lock_manager.shared('targets'):
+                        self.target_allocator.release(iscsi_name)
+                raise iexception.ISCSITargetCreateFailed(volume_id=volume['id'])
+        tid = iscsi_target
         data = {}
         data['location'] = self.target_helper._iscsi_location(
             conf.iscsi_ip_address, tid, iscsi_name, conf.iscsi_port, lun)
@@ -225,24 +767,98 @@ class SurIscsiVolumeDriver(driver.VolumeDriver):
             'provider_auth': data['auth'],
         }
        
+    @metrics.timed('remove_export')
     def remove_export(self, context, volume):
         # self.target_helper.remove_export(context, volume)
-        try:
-            iscsi_target = self.db.volume_get_iscsi_target_num(context, volume['id'])
-        except exception.NotFound:
-            LOG.info("Skipping remove_export. No iscsi_target, provisioned for volume: %s" % volume['id'])
-            return
+        iscsi_name = "%s%s" % (self.configuration.iscsi_target_prefix,
+                               volume['name'])
+        with self.lock_manager.volume(volume['id']):
+            # the allocator knows every target of this host since do_setup
+            if self.target_allocator.lookup(iscsi_name) is None:
+                LOG.info("Skipping remove_export. No iscsi_target, provisioned for volume: %s" % volume['id'])
+                return
 
-        self.targetbase.remove_iscsi_target(iscsi_target, 0, volume['id'], volume['name'])
-        try:
-            self.initiator_manager.remove_vol_initname_pair(volume['id'])
-        except:
-            LOG.warn('Failed to remove initiator for the volume %s' &volume['name'])
+            try:
+                self.lio_client.delete_target(iscsi_name)
+            except putils.ProcessExecutionError:
+                LOG.error('Failed to remove iscsi target for volume %s' % volume['id'])
+                raise iexception.ISCSITargetRemoveFailed(volume_id=volume['id'])
+            with self.lock_manager.shared('targets'):
+                self.target_allocator.release(iscsi_name)
+            self.chap_cache.invalidate(iscsi_name)
+            try:
+                with self.lock_manager.shared('initiators'):
+                    self.initiator_manager.remove_vol_initname_pair(volume['id'])
+            except:
+                LOG.warn('Failed to remove initiator for the volume %s' % volume['name'])
         
+    @metrics.timed('detach_initiator')
+    def detach_initiator(self, context, initiator_iqn):
+        """Tear down the exports of every volume attached from initiator_iqn.
+
+        For a dead or evacuated compute host: the volumes come from one
+        lookup in the initiator table, their ACLs and targets are removed
+        in one LIO batch, and the initiator table and the LIO config are
+        written once. Targets still used by another initiator only lose
+        the ACL. Returns {volume id: error} of the volumes that failed.
+        """
+        with self.lock_manager.shared('initiators'):
+            vol_ids = self.initiator_manager.get_vols_by_initname(initiator_iqn)
+        if not vol_ids:
+            LOG.info('No volumes attached from %s' % initiator_iqn)
+            return {}
+        prefix = self.configuration.iscsi_target_prefix
+        failures = {}
+        with self.lock_manager.volumes(vol_ids):
+            # one consistent read of who else uses each volume
+            with self.lock_manager.shared('initiators'):
+                initnames = dict(
+                    (vol_id, self.initiator_manager.get_vol_initnames(vol_id))
+                    for vol_id in vol_ids)
+            # (method, kwargs) per LIO change, owners[i] is its volume
+            ops, owners, deleted = [], [], {}
+            for vol_id in vol_ids:
+                iscsi_name = "%s%s" % (prefix, CONF.volume_name_template % vol_id)
+                if self.target_allocator.lookup(iscsi_name) is None:
+                    # no target on this host, only the record is stale
+                    continue
+                ops.append(('remove_initiator', {'target_iqn': iscsi_name,
+                                                 'initiator_iqn': initiator_iqn}))
+                owners.append(vol_id)
+                others = [i for i in initnames[vol_id] if i != initiator_iqn]
+                if not others:
+                    ops.append(('delete_target', {'name': iscsi_name}))
+                    owners.append(vol_id)
+                    deleted[vol_id] = iscsi_name
+            for (index, error) in self.lio_client.batch(ops).items():
+                failures.setdefault(owners[index], error)
+            with self.lock_manager.shared('targets'):
+                for (vol_id, iscsi_name) in deleted.items():
+                    if vol_id not in failures:
+                        self.target_allocator.release(iscsi_name)
+                        self.chap_cache.invalidate(iscsi_name)
+            # failed volumes keep their record so a retry finds them again
+            with self.lock_manager.shared('initiators'):
+                self.initiator_manager.remove_initname(
+                    initiator_iqn, [v for v in vol_ids if v not in failures])
+            if ops:
+                self._save_lio_config()
+        for (vol_id, error) in failures.items():
+            LOG.error('Failed to detach volume %s from %s: %s'
+                      % (vol_id, initiator_iqn, error))
+        LOG.info('Detached %d volumes from %s, %d failed'
+                 % (len(vol_ids), initiator_iqn, len(failures)))
+        return failures
+
     def validate_connector(self, connector):
         self.iscsiobj.validate_connector(connector)
         
+    @metrics.timed('initialize_connection')
     def initialize_connection(self, volume, connector):
+        with self.lock_manager.volume(volume['id']):
+            return self._initialize_connection(volume, connector)
+
+    def _initialize_connection(self, volume, connector):
         if CONF.iscsi_helper == 'lioadm':
             # self.target_helper.initialize_connection(volume, connector)
             volume_iqn = volume['provider_location'].split(' ')[1]
@@ -252,19 +868,18 @@ class SurIscsiVolumeDriver(driver.VolumeDriver):
 
         # Add initiator iqns to target ACL
             try:
-                self._execute('cinder-rtstool', 'add-initiator',
-                          volume_iqn,
-                          auth_user,
-                          auth_pass,
-                          connector['initiator'],
-                          run_as_root=True)
+                self.lio_client.add_initiator(volume_iqn,
+                                              auth_user,
+                                              auth_pass,
+                                              connector['initiator'])
             except putils.ProcessExecutionError:
                 LOG.error(_("Failed to add initiator iqn %s to target") % connector['initiator'])
                 raise iexception.ISCSITargetAttachFailed(volume_id=volume['id'])
 
         iscsi_properties = self.iscsiobj._get_iscsi_properties(volume)
         try:
-            self.initiator_manager.add_vol_initname_pair(volume['id'], connector['initiator'])
+            with self.lock_manager.shared('initiators'):
+                self.initiator_manager.add_vol_initname_pair(volume['id'], connector['initiator'])
         except:
             LOG.warn('Failed to record the initiator for the volume %s'%volume['id'])
         return {
@@ -272,76 +887,356 @@ class SurIscsiVolumeDriver(driver.VolumeDriver):
             'data': iscsi_properties
         }
         
+    @metrics.timed('ensure_export')
     def ensure_export(self, context, volume):
-         
-        iscsi_name = "%s%s" % (self.configuration.iscsi_target_prefix,
-                               volume['name'])
+        """Recreate the export of one volume, see ensure_exports.
 
-        volume_path = self._get_volume_devpath(volume['name'])
-        # NOTE(jdg): For TgtAdm case iscsi_name is the ONLY param we need
-        # should clean this all up at some point in the future
-        model_update = self._ensure_export(
-            context, volume,
-            iscsi_name,
-            volume_path,
-            self.configuration.zfspool,
-            self.configuration)
-        if model_update:
-            self.target_helper.db.volume_update(context, volume['id'], model_update)
-            
-    def _ensure_export(self, context, volume, iscsi_name, volume_path,
-                      vg_name, conf, old_name=None):
-        try:
-            volume_info = self.target_helper.db.volume_get(context, volume['id'])
-        except exception.NotFound:
-            LOG.info(_("Skipping ensure_export. No iscsi_target "
-                       "provision for volume: %s"), volume['id'])
+        Volumes already ensured by do_setup are skipped, so the calls the
+        manager makes for every volume at start-up cost nothing.
+        """
+        if volume['id'] in self._setup_ensured:
+            self._setup_ensured.discard(volume['id'])
             return
+        self._ensure_exports(context, [volume], {})
+
+    def ensure_exports(self, context, volumes):
+        """Recreate the exports of many volumes, e.g. at service start.
+
+        Volume records are read with one query per host, targets and ACLs
+        are created with at most ensure_export_concurrency volumes in
+        flight and the LIO config is saved once at the end. Targets LIO
+        already has keep their ACLs restored, volumes without a zvol or
+        export are skipped. A failing volume does not stop the others;
+        returns {volume id: error}.
+        """
+        volumes = list(volumes)
+        records = {}
+        for host in set(v['host'] for v in volumes):
+            for record in self.db.volume_get_all_by_host(context, host):
+                records[record['id']] = record
+        return self._ensure_exports(context, volumes, records)
+
+    def _ensure_exports(self, context, volumes, records):
+        # records: volume id -> db record, the missing ones are queried
+        self._cache_chap_auths(records.values())
+        prefix = self.configuration.iscsi_target_prefix
 
+        def _ensure_one(volume):
+            try:
+                if self._zvol_missing(volume['name']):
+                    raise exception.NotFound()
+                volume_info = records.get(volume['id'])
+                if volume_info is None:
+                    volume_info = self.db.volume_get(context, volume['id'])
+                with self.lock_manager.volume(volume['id']):
+                    self._create_lio_export(
+                        "%s%s" % (prefix, volume['name']),
+                        self._get_volume_devpath(volume['name']),
+                        volume_info, volume['id'])
+            except exception.NotFound:
+                LOG.info('Skipping ensure_export, nothing exported for '
+                         'volume %s' % volume['id'])
+                return (volume['id'], False, None)
+            except Exception as e:
+                return (volume['id'], False, e)
+            return (volume['id'], True, None)
+
+        failures = {}
+        exported = 0
+        pool = greenpool.GreenPool(
+            self.configuration.safe_get('ensure_export_concurrency'))
+        for (vol_id, done, error) in pool.imap(_ensure_one, volumes):
+            if error is not None:
+                LOG.error('Failed to ensure export for volume %s: %s'
+                          % (vol_id, error))
+                failures[vol_id] = error
+            elif done:
+                exported += 1
+        if exported:
+            self._save_lio_config()
+        if len(volumes) > 1:
+            LOG.info('Ensured exports for %d volumes, %d failed'
+                     % (len(volumes), len(failures)))
+        return failures
+
+    def _create_lio_export(self, iscsi_name, volume_path, volume_info, volid):
+        # the caller saves the LIO config
+        if not volume_info['provider_auth']:
+            raise exception.NotFound()
+        with self.lock_manager.shared('targets'):
+            # targets found in configfs at do_setup are known already
+            existed = self.target_allocator.lookup(iscsi_name) is not None
+            target = self.target_allocator.allocate(iscsi_name)
+        if target is None:
+            raise exception.NoMoreTargets()
         (auth_method,
          auth_user,
          auth_pass) = volume_info['provider_auth'].split(' ', 3)
-        chap_auth = self.target_helper._iscsi_authentication(auth_method,
-                                               auth_user,
-                                               auth_pass)
+        if not existed:
+            try:
+                self.lio_client.create_target(
+                    iscsi_name, volume_path, auth_user, auth_pass,
+                    self.configuration.safe_get('lio_initiator_iqns'))
+            except putils.ProcessExecutionError as e:
+                # the usual state after a cinder-volume restart
+                if 'exist' not in str(e).lower():
+                    raise
+        self._ensure_patch(iscsi_name, auth_user, auth_pass, volid)
+
+    def _save_lio_config(self):
+        try:
+            # one writer of the saved config at a time on the host
+            with self.lock_manager.shared('targets'):
+                self.lio_client.save()
+        except putils.ProcessExecutionError:
+            LOG.warn('Failed to save the LIO configuration')
 
-        iscsi_target = 1
-        
-        self.targetbase.create_iscsi_target(iscsi_name, iscsi_target, 0, volume_path,
-                                 chap_auth, check_exit_code=False)
-        
-        self.ensure_patch(iscsi_name,auth_user,auth_pass,volume['id'])
-        
     def _ensure_patch(self,iscsi_name,auth_usrid,auth_passwd,volid):
-        initname=self.initiator_manager.get_vol_initname(volid)
-        if initname is None or initname=='':
+        initnames=self.initiator_manager.get_vol_initnames(volid)
+        if len(initnames)==0:
             LOG.warn('Failed to get initname for volume-%s'%volid)
             return
-        try:
-            self._execute('cinder-rtstool', 'add-initiator',
-                          iscsi_name,
-                          auth_usrid,
-                          auth_passwd,
-                          initname,
-                          run_as_root=True)
-        except:
-            LOG.warn('Failed to add-initiator for volume-%s'%volid)                      
+        for initname in initnames:
+            try:
+                self.lio_client.add_initiator(iscsi_name,
+                                              auth_usrid,
+                                              auth_passwd,
+                                              initname)
+            except:
+                LOG.warn('Failed to add-initiator for volume-%s'%volid)                      
 
     def get_volume_stats(self, refresh=False):
         """Get volume status.
 
-        If 'refresh' is True, run update the stats first.
+        Stats are collected in the background every volume_stats_interval
+        seconds, this always returns the last snapshot without waiting
+        for the backend; 'refresh' only makes sure the collector runs.
         """  
         if refresh:
+            self._start_stats_timer()
+        if not self._stats:
+            return self._base_stats()
+        return self._stats    
+
+    def _start_stats_timer(self):
+        if self._stats_timer is not None:
+            return
+        self._stats_timer = loopingcall.FixedIntervalLoopingCall(
+            self._refresh_stats)
+        self._stats_timer.start(
+            interval=self.configuration.safe_get('volume_stats_interval'),
+            initial_delay=0)
+
+    def _refresh_stats(self):
+        try:
             self._stats = self._update_volume_stats()
+        except Exception as e:
+            # keep reporting the last good snapshot
+            LOG.warn('Failed to update volume stats: %s' % e)
+        if self.configuration.safe_get('metrics_enabled'):
+            try:
+                self.dump_metrics()
+            except (IOError, OSError) as e:
+                LOG.warn('Failed to dump metrics: %s' % e)
+
+    def dump_metrics(self, path=None, fmt=None):
+        """Write the metrics file now, returns its path."""
+        path = path or self.configuration.safe_get('metrics_dump_path')
+        metrics.REGISTRY.dump(
+            path, fmt or self.configuration.safe_get('metrics_dump_format'))
+        return path
+
+    def _base_stats(self):
+        backend_name = self.configuration.safe_get('volume_backend_name')
+        return {
+            'volume_backend_name': backend_name or self.__class__.__name__,
+            'vendor_name': 'Sursen',
+            'driver_version': self.VERSION,
+            'storage_protocol': 'iSCSI',
+            'total_capacity_gb': 'unknown',
+            'free_capacity_gb': 'unknown',
+            'reserved_percentage':
+                self.configuration.safe_get('reserved_percentage'),
+            'QoS_support': False,
+        }
+
+    def _update_volume_stats(self):
+        data = self._base_stats()
+        # the cached listing exists() and the snapshot calls use
+        capacity = self.zfs.table.capacity()
+        gib = float(1024 ** 3)
+        data['total_capacity_gb'] = round(capacity['total'] / gib, 2)
+        data['free_capacity_gb'] = round(capacity['free'] / gib, 2)
+        data['allocated_capacity_gb'] = round(capacity['allocated'] / gib, 2)
+        # volsize of every zvol, the same listing, no db query
+        data['provisioned_capacity_gb'] = round(
+            capacity['provisioned'] / gib, 2)
+        data['total_volumes'] = capacity['volumes']
+        data['allocated_ratio'] = round(capacity['allocated_ratio'], 4)
+        data['provisioned_ratio'] = round(capacity['provisioned_ratio'], 4)
+        return data
+
 
-        return self._stats    
-                                
-    
 class SurRemotefsDriver(remotefs.RemoteFSDriver):
-    def __init__(self):
+    """File volumes on xfs/btrfs (or nfs 4.2 over them) shares.
+
+    Snapshots, clones and volumes from snapshots are reflinks of the
+    source file, with a sparse copy when the share cannot reflink. The
+    shares config is re-read only when the file changes and mounted
+    shares are remembered instead of probed through mount on every call.
+    """
+    driver_volume_type = 'nfs'
+    driver_prefix = 'sur'
+    volume_backend_name = 'SurRemotefs'
+    VERSION = '1.0.0'
+    # local images and devices are shares too, not only host:/path
+    SHARE_FORMAT_REGEX = r'.+'
+
+    def __init__(self, *args, **kwargs):
+        super(SurRemotefsDriver, self).__init__(*args, **kwargs)
+        self.configuration.append_config_values(volume_opts)
+        # share -> mount point, for shares known to be mounted
+        self._mount_points = {}
+        self._shares_mtime = None
+        # share -> whether its filesystem reflinks, learnt on first clone
+        self._reflink_shares = {}
+
+    def do_setup(self, context):
+        config = self.configuration.safe_get('sur_shares_config')
+        if not config or not os.path.exists(config):
+            raise exception.VolumeBackendAPIException(
+                data='Shares config %s not found' % config)
+
+    def check_for_setup_error(self):
         pass
 
+    def _get_mount_point_for_share(self, share):
+        mount_point = self._mount_points.get(share)
+        if mount_point is None:
+            mount_point = os.path.join(
+                self.configuration.safe_get('sur_mount_point_base'),
+                hashlib.md5(share).hexdigest())
+        return mount_point
+
+    def _load_shares_if_changed(self):
+        config = self.configuration.safe_get('sur_shares_config')
+        try:
+            mtime = os.stat(config).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._shares_mtime:
+            return
+        self._load_shares_config(config)
+        self._shares_mtime = mtime
+        for share in list(self._mount_points):
+            if share not in self.shares:
+                del self._mount_points[share]
+
+    def _ensure_shares_mounted(self):
+        self._load_shares_if_changed()
+        mounted_shares = []
+        for share in self.shares:
+            mount_point = self._mount_points.get(share)
+            # a stat, not a mount(8) call, for shares already mounted
+            if mount_point is None or not os.path.ismount(mount_point):
+                try:
+                    self._ensure_share_mounted(share)
+                except Exception as e:
+                    LOG.error('Failed to mount share %s: %s' % (share, e))
+                    continue
+            mounted_shares.append(share)
+        self._mounted_shares = mounted_shares
+
+    def _ensure_share_mounted(self, share):
+        mount_point = self._get_mount_point_for_share(share)
+        if not os.path.isdir(mount_point):
+            os.makedirs(mount_point)
+        if not os.path.ismount(mount_point):
+            cmd = ['mount', '-t', self.configuration.safe_get('sur_fs_type')]
+            options = self.shares.get(share) or \
+                self.configuration.safe_get('sur_mount_options')
+            if options:
+                cmd.extend(['-o', options.replace('-o', '').strip()])
+            cmd.extend([share, mount_point])
+            self._execute(*cmd, run_as_root=True)
+        self._mount_points[share] = mount_point
+
+    def _get_capacity_info(self, share):
+        """(total, available, allocated) bytes of a mounted share."""
+        st = os.statvfs(self._get_mount_point_for_share(share))
+        total = st.f_blocks * st.f_frsize
+        available = st.f_bavail * st.f_frsize
+        return (total, available, total - st.f_bfree * st.f_frsize)
+
+    def _find_share(self, volume_size_in_gib):
+        if not self._mounted_shares:
+            raise exception.VolumeBackendAPIException(
+                data='No mounted share for a %sG volume' % volume_size_in_gib)
+        (free, share) = max((self._get_capacity_info(s)[1], s)
+                            for s in self._mounted_shares)
+        if free < int(volume_size_in_gib) * 1024 ** 3:
+            raise exception.VolumeBackendAPIException(
+                data='No share with %sG free' % volume_size_in_gib)
+        return share
+
+    def _snapshot_volume(self, snapshot):
+        volume = snapshot.get('volume')
+        if volume is None:
+            volume = self.db.volume_get(ccontext.get_admin_context(),
+                                        snapshot['volume_id'])
+        return volume
+
+    def _snapshot_path(self, snapshot):
+        volume = self._snapshot_volume(snapshot)
+        return os.path.join(os.path.dirname(self.local_path(volume)),
+                            snapshot['name'])
+
+    def _clone(self, share, src_path, dst_path, size=None):
+        """Reflink src_path to dst_path, sparse copy as the fallback."""
+        if not os.access(os.path.dirname(dst_path), os.W_OK):
+            # let root create the file, it is written from here
+            self._execute('touch', dst_path, run_as_root=True)
+            self._set_rw_permissions_for_all(dst_path)
+        start = time.time()
+        # a fallback copy of a big volume must not block the hub
+        method = tpool.execute(reflink.clone_file, src_path, dst_path, size)
+        self._set_rw_permissions_for_all(dst_path)
+        reflinked = method == 'reflink'
+        if not reflinked and self._reflink_shares.get(share, True):
+            LOG.warn('Share %s cannot reflink, volumes are copied' % share)
+        self._reflink_shares[share] = reflinked
+        LOG.info('Cloned %s to %s with %s in %.3fs'
+                 % (src_path, dst_path, method, time.time() - start))
+        return method
+
+    def create_snapshot(self, snapshot):
+        volume = self._snapshot_volume(snapshot)
+        self._ensure_shares_mounted()
+        self._clone(volume['provider_location'], self.local_path(volume),
+                    self._snapshot_path(snapshot))
+
+    def delete_snapshot(self, snapshot):
+        path = self._snapshot_path(snapshot)
+        if os.path.exists(path):
+            self._execute('rm', '-f', path, run_as_root=True)
+
+    def _create_from_file(self, volume, share, src_path):
+        # a reflink needs both files on the same filesystem
+        volume['provider_location'] = share
+        self._ensure_shares_mounted()
+        self._clone(share, src_path, self.local_path(volume),
+                    int(volume['size']) * 1024 ** 3)
+        return {'provider_location': share}
+
+    def create_volume_from_snapshot(self, volume, snapshot):
+        source = self._snapshot_volume(snapshot)
+        return self._create_from_file(volume, source['provider_location'],
+                                      self._snapshot_path(snapshot))
+
+    def create_cloned_volume(self, volume, src_vref):
+        return self._create_from_file(volume, src_vref['provider_location'],
+                                      self.local_path(src_vref))
+
 class SurFibreChannelDriver(driver.FibreChannelDriver):
     def __init__(self):
         pass
@@ -0,0 +1,592 @@
+# author:sursen
+# TokenBucket: byte rate throttle
+# VolumeCopier: in-process volume copy, kernel side when possible,
+#               skips holes and zero blocks when the target reads as zero
+# ChunkedMigration: parallel chunk copy resumable from an on-disk checkpoint
+import os
+import io
+import mmap
+import stat
+import time
+import zlib
+import array
+import errno
+import ctypes
+import struct
+import logging
+import tempfile
+import ctypes.util
+from cinder.volume.drivers.sursen import common
+
+# the copy workers block in read/write, they are OS threads even when
+# cinder-volume runs monkey patched
+threading = common.native_module('threading')
+Queue = common.native_module('Queue')
+
+LOG = logging.getLogger(__name__)
+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+ALIGN = 4096
+
+try:
+    _slice = buffer
+except NameError:
+    def _slice(buf, offset, size):
+        return memoryview(buf)[offset:offset + size]
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+    return _libc
+
+
+def parse_blocksize(value, default=1024 * 1024):
+    """'1M', '512K', '4096' -> bytes, default unless a multiple of 512."""
+    if value is None:
+        return default
+    value = str(value).strip().upper()
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    factor = 1
+    if value[-1:] in units:
+        factor = units[value[-1]]
+        value = value[:-1]
+    if not value.isdigit():
+        return default
+    size = int(value) * factor
+    if size <= 0 or size % 512 != 0:
+        return default
+    return size
+
+
+def get_size(fd):
+    st = os.fstat(fd)
+    if stat.S_ISREG(st.st_mode):
+        return st.st_size
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def data_extents(fd, start, end):
+    """(offset, length) of the data in [start, end), holes left out.
+
+    Devices and filesystems without SEEK_DATA give one extent.
+    """
+    offset = start
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            yield (offset, end - offset)
+            return
+        if data >= end:
+            return
+        try:
+            hole = min(os.lseek(fd, data, SEEK_HOLE), end)
+        except OSError:
+            hole = end
+        yield (data, hole - data)
+        offset = hole
+
+
+def _copy_file_range(src_fd, src_off, dst_fd, dst_off, count):
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(src_fd, dst_fd, count, src_off, dst_off)
+    off_in = ctypes.c_longlong(src_off)
+    off_out = ctypes.c_longlong(dst_off)
+    func = _get_libc().copy_file_range
+    func.restype = ctypes.c_ssize_t
+    n = func(src_fd, ctypes.byref(off_in), dst_fd, ctypes.byref(off_out),
+             ctypes.c_size_t(count), 0)
+    if n < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return n
+
+
+def _sendfile(src_fd, src_off, dst_fd, dst_off, count):
+    os.lseek(dst_fd, dst_off, os.SEEK_SET)
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(dst_fd, src_fd, src_off, count)
+    offset = ctypes.c_longlong(src_off)
+    func = _get_libc().sendfile64
+    func.restype = ctypes.c_ssize_t
+    n = func(dst_fd, src_fd, ctypes.byref(offset), ctypes.c_size_t(count))
+    if n < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return n
+
+
+class TokenBucket(object):
+    """Blocks consumers so that on average at most rate bytes/s pass."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, count):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= count
+            wait = -self.tokens / float(self.rate)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class VolumeCopier(object):
+    """Copies a volume inside this process.
+
+    Without zero skipping the data is moved by the kernel with
+    copy_file_range, or sendfile, or through one page aligned O_DIRECT
+    buffer. When the target is known to read as zero (a regular file
+    created or truncated here, or dst_zeroed=True for a fresh thin
+    volume), source holes are skipped with SEEK_DATA/SEEK_HOLE and
+    all-zero blocks are not written, so sparse targets stay sparse.
+    Bandwidth is limited with a TokenBucket and progress is reported
+    through progress_callback(done, total, mb_per_second).
+    """
+    def __init__(self, blocksize=1024 * 1024, bps_limit=0, direct=True,
+                 progress_callback=None, progress_interval=5.0):
+        self.blocksize = max(ALIGN, blocksize - blocksize % ALIGN)
+        self.bps_limit = bps_limit
+        self.direct = direct
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        self._kernel_copy = [_copy_file_range, _sendfile]
+
+    def _open_dst(self, dst_path):
+        """Returns (fd, reads_as_zero)."""
+        if os.path.exists(dst_path) and \
+                not stat.S_ISREG(os.stat(dst_path).st_mode):
+            return (os.open(dst_path, os.O_WRONLY), False)
+        return (os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                        0o644), True)
+
+    def copy(self, src_path, dst_path, size=None, dst_zeroed=False):
+        """Copy size bytes (default: all of src), returns a result dict."""
+        src_fd = os.open(src_path, os.O_RDONLY)
+        try:
+            (dst_fd, created) = self._open_dst(dst_path)
+            try:
+                if size is None:
+                    size = get_size(src_fd)
+                result = self._copy_fds(src_fd, src_path, dst_fd, size,
+                                        dst_zeroed or created)
+                if created:
+                    os.ftruncate(dst_fd, size)
+                os.fsync(dst_fd)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        LOG.info('Copied %s to %s: %d bytes written, %d skipped, %s, '
+                 '%.1f MB/s' % (src_path, dst_path, result['written'],
+                                result['skipped'], result['method'],
+                                result['mbps']))
+        return result
+
+    def _copy_fds(self, src_fd, src_path, dst_fd, size, skip_zeroes):
+        self._bucket = TokenBucket(self.bps_limit,
+                                   max(self.bps_limit, self.blocksize))
+        self._start = self._last_report = time.time()
+        self._done = 0
+        self._written = 0
+        self._total = size
+        method = None
+        if skip_zeroes:
+            method = self._copy_buffered(src_fd, src_path, dst_fd, size, True)
+        else:
+            method = self._copy_kernel(src_fd, dst_fd, size)
+            if method is None:
+                method = self._copy_buffered(src_fd, src_path, dst_fd, size,
+                                             False)
+        elapsed = max(time.time() - self._start, 1e-6)
+        return {'bytes': size, 'written': self._written,
+                'skipped': size - self._written, 'method': method,
+                'seconds': elapsed,
+                'mbps': self._written / elapsed / (1024 * 1024)}
+
+    def _progress(self, count, written, read=True):
+        self._done += count
+        self._written += written
+        if read:
+            self._bucket.consume(count)
+        now = time.time()
+        if self.progress_callback is not None and \
+                (now - self._last_report >= self.progress_interval or
+                 self._done >= self._total):
+            self._last_report = now
+            elapsed = max(now - self._start, 1e-6)
+            self.progress_callback(self._done, self._total,
+                                   self._done / elapsed / (1024 * 1024))
+
+    def _copy_kernel(self, src_fd, dst_fd, size):
+        while self._kernel_copy:
+            func = self._kernel_copy[0]
+            offset = self._done
+            try:
+                while offset < size:
+                    n = func(src_fd, offset, dst_fd, offset,
+                             min(self.blocksize, size - offset))
+                    if n <= 0:
+                        break
+                    offset += n
+                    self._progress(n, n)
+                return func.__name__.strip('_')
+            except (OSError, AttributeError) as e:
+                if isinstance(e, OSError) and e.errno not in (
+                        errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                # not supported for this pair, try the next method from
+                # where this one stopped
+                self._kernel_copy.pop(0)
+        return None
+
+    def _open_direct(self, src_fd, src_path):
+        if not self.direct or not O_DIRECT:
+            return None
+        try:
+            return os.open(src_path, os.O_RDONLY | O_DIRECT)
+        except OSError:
+            return None
+
+    def _copy_buffered(self, src_fd, src_path, dst_fd, size, skip_zeroes):
+        buf = mmap.mmap(-1, self.blocksize)
+        zeros = mmap.mmap(-1, self.blocksize)
+        direct_fd = self._open_direct(src_fd, src_path)
+        reader = io.FileIO(direct_fd if direct_fd is not None else src_fd,
+                           'r', closefd=False)
+        method = 'direct' if direct_fd is not None else 'buffered'
+        data = None
+        try:
+            start = self._done
+            extents = [(start, size - start)]
+            if skip_zeroes:
+                extents = data_extents(src_fd, start, size)
+            for (ext_off, ext_len) in extents:
+                if ext_off > self._done:
+                    # hole in the source, nothing to write
+                    self._progress(ext_off - self._done, 0, read=False)
+                offset = ext_off
+                end = ext_off + ext_len
+                while offset < end:
+                    count = min(self.blocksize, end - offset)
+                    if reader.fileno() != src_fd and offset % ALIGN:
+                        # unaligned offsets can't go through O_DIRECT
+                        reader = io.FileIO(src_fd, 'r', closefd=False)
+                    os.lseek(reader.fileno(), offset, os.SEEK_SET)
+                    n = reader.readinto(buf)
+                    n = min(n or 0, count)
+                    if n <= 0:
+                        break
+                    data = _slice(buf, 0, n)
+                    if skip_zeroes and data == _slice(zeros, 0, n):
+                        self._progress(n, 0)
+                    else:
+                        os.lseek(dst_fd, offset, os.SEEK_SET)
+                        written = 0
+                        while written < n:
+                            written += os.write(dst_fd,
+                                                _slice(buf, written,
+                                                       n - written))
+                        self._progress(n, n)
+                    offset += n
+            if self._done < size:
+                self._progress(size - self._done, 0, read=False)
+        finally:
+            # drop the last view so the buffers can be unmapped
+            data = None
+            if direct_fd is not None:
+                os.close(direct_fd)
+            buf.close()
+            zeros.close()
+        if skip_zeroes:
+            method += '+sparse'
+        return method
+
+
+class MigrationCheckpoint(object):
+    """Done-chunk bitmap plus a crc32 per chunk, saved atomically.
+
+    Layout: header (magic, size, chunk size, chunk count), the bitmap
+    bytes, then one unsigned 32 bit crc per chunk.
+    """
+    MAGIC = b'SURCKPT1'
+    _HEADER = struct.Struct('<8sQQQ')
+
+    def __init__(self, path, size, chunk_size):
+        self.path = path
+        self.size = size
+        self.chunk_size = chunk_size
+        self.nchunks = (size + chunk_size - 1) // chunk_size
+        self.bitmap = bytearray((self.nchunks + 7) // 8)
+        self.crcs = array.array('I', [0] * self.nchunks)
+
+    def load(self):
+        """True if a checkpoint for the same size and chunking was read."""
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+        except IOError:
+            return False
+        if len(raw) < self._HEADER.size:
+            return False
+        (magic, size, chunk_size, nchunks) = self._HEADER.unpack_from(raw)
+        if (magic, size, chunk_size, nchunks) != \
+                (self.MAGIC, self.size, self.chunk_size, self.nchunks):
+            return False
+        offset = self._HEADER.size
+        bitmap = raw[offset:offset + len(self.bitmap)]
+        crcs = array.array('I')
+        raw_crcs = raw[offset + len(self.bitmap):]
+        if len(raw_crcs) % crcs.itemsize:
+            return False
+        if hasattr(crcs, 'frombytes'):
+            crcs.frombytes(raw_crcs)
+        else:
+            crcs.fromstring(raw_crcs)
+        if len(bitmap) != len(self.bitmap) or len(crcs) != self.nchunks:
+            return False
+        self.bitmap = bytearray(bitmap)
+        self.crcs = crcs
+        return True
+
+    def save(self):
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        (fd, tmppath) = tempfile.mkstemp(dir=dirname, prefix='.ckpt.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._HEADER.pack(self.MAGIC, self.size,
+                                          self.chunk_size, self.nchunks))
+                f.write(bytes(self.bitmap))
+                if hasattr(self.crcs, 'tobytes'):
+                    f.write(self.crcs.tobytes())
+                else:
+                    f.write(self.crcs.tostring())
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmppath, self.path)
+        except:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+
+    def is_done(self, index):
+        return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    def mark_done(self, index, crc):
+        self.bitmap[index >> 3] |= 1 << (index & 7)
+        self.crcs[index] = crc
+
+    def missing(self):
+        return [i for i in range(self.nchunks) if not self.is_done(i)]
+
+    def clear(self, index):
+        self.bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xff
+        self.crcs[index] = 0
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ChunkedMigration(object):
+    """Copies src to dst in fixed-size chunks with parallel workers.
+
+    Finished chunks are recorded in a MigrationCheckpoint, flushed after
+    the target was synced, so a migration restarted with the same
+    checkpoint_path only copies the chunks that are still missing. A
+    checkpoint found on disk may come from a run to another target, its
+    chunks are verified against dst_path before they are skipped. All
+    workers share one TokenBucket of bps_limit bytes/s. With dst_zeroed
+    all-zero blocks are read but not written, so thin targets stay thin.
+    """
+    def __init__(self, src_path, dst_path, checkpoint_path, size,
+                 chunk_size=64 * 1024 * 1024, workers=4, bps_limit=0,
+                 blocksize=1024 * 1024, checkpoint_interval=5.0,
+                 progress_callback=None, dst_zeroed=False):
+        self.src_path = src_path
+        self.dst_path = dst_path
+        self.size = size
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.blocksize = blocksize
+        self.dst_zeroed = dst_zeroed
+        self.checkpoint_interval = checkpoint_interval
+        self.progress_callback = progress_callback
+        self.checkpoint = MigrationCheckpoint(checkpoint_path, size,
+                                              chunk_size)
+        self.bucket = TokenBucket(bps_limit, max(bps_limit, blocksize))
+        self._lock = threading.Lock()
+        self._errors = []
+        self._verified = False
+
+    def _copy_chunk(self, src_fd, dst_fd, index, buf, zeros=None):
+        offset = index * self.chunk_size
+        end = min(offset + self.chunk_size, self.size)
+        crc = 0
+        reader = io.FileIO(src_fd, 'r', closefd=False)
+        while offset < end:
+            count = min(self.blocksize, end - offset)
+            os.lseek(src_fd, offset, os.SEEK_SET)
+            n = reader.readinto(buf)
+            n = min(n or 0, count)
+            if n <= 0:
+                raise IOError(errno.EIO, 'short read at %d of %s'
+                              % (offset, self.src_path))
+            self.bucket.consume(n)
+            data = _slice(buf, 0, n)
+            crc = zlib.crc32(data, crc)
+            if zeros is None or data != _slice(zeros, 0, n):
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                written = 0
+                while written < n:
+                    written += os.write(dst_fd,
+                                        _slice(buf, written, n - written))
+            data = None
+            offset += n
+        return crc & 0xffffffff
+
+    def _worker(self, chunks, done):
+        try:
+            src_fd = os.open(self.src_path, os.O_RDONLY)
+            try:
+                dst_fd = os.open(self.dst_path, os.O_WRONLY)
+            except:
+                os.close(src_fd)
+                raise
+        except Exception as e:
+            # run() raises it, a dead worker must not pass for a done one
+            self._errors.append(e)
+            return
+        buf = mmap.mmap(-1, self.blocksize)
+        zeros = mmap.mmap(-1, self.blocksize) if self.dst_zeroed else None
+        try:
+            while not self._errors:
+                try:
+                    index = chunks.get_nowait()
+                except Queue.Empty:
+                    break
+                crc = self._copy_chunk(src_fd, dst_fd, index, buf, zeros)
+                done.put((index, crc))
+        except Exception as e:
+            self._errors.append(e)
+        finally:
+            buf.close()
+            if zeros is not None:
+                zeros.close()
+            os.close(dst_fd)
+            os.close(src_fd)
+
+    def _flush_checkpoint(self, pending):
+        # chunks are only recorded once their data is on disk
+        dst_fd = os.open(self.dst_path, os.O_WRONLY)
+        try:
+            os.fsync(dst_fd)
+        finally:
+            os.close(dst_fd)
+        for (index, crc) in pending:
+            self.checkpoint.mark_done(index, crc)
+        self.checkpoint.save()
+
+    def run(self):
+        """Copy the missing chunks, returns the number of chunks copied.
+
+        Blocks until done, call it from a native thread (tpool).
+        """
+        # a previous failed run must not stop this one
+        self._errors = []
+        if self.checkpoint.load():
+            LOG.info('Resuming migration of %s from %s'
+                     % (self.src_path, self.checkpoint.path))
+            if not self._verified:
+                bad = self.verify()
+                for index in bad:
+                    self.checkpoint.clear(index)
+                if bad:
+                    LOG.info('%d checkpointed chunks do not match %s, '
+                             'copying them again' % (len(bad), self.dst_path))
+        self._verified = True
+        missing = self.checkpoint.missing()
+        chunks = Queue.Queue()
+        for index in missing:
+            chunks.put(index)
+        done = Queue.Queue()
+        threads = [threading.Thread(target=self._worker, args=(chunks, done))
+                   for _ in range(min(self.workers, len(missing)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        pending = []
+        copied = 0
+        last_save = start = time.time()
+        total_done = self.checkpoint.nchunks - len(missing)
+        while any(t.is_alive() for t in threads) or not done.empty():
+            try:
+                pending.append(done.get(timeout=0.5))
+            except Queue.Empty:
+                pass
+            if pending and time.time() - last_save >= \
+                    self.checkpoint_interval:
+                self._flush_checkpoint(pending)
+                copied += len(pending)
+                pending = []
+                last_save = time.time()
+                if self.progress_callback is not None:
+                    elapsed = max(last_save - start, 1e-6)
+                    self.progress_callback(
+                        total_done + copied, self.checkpoint.nchunks,
+                        copied * self.chunk_size / elapsed / (1024 * 1024))
+        for t in threads:
+            t.join()
+        if pending:
+            self._flush_checkpoint(pending)
+            copied += len(pending)
+        if self._errors:
+            raise self._errors[0]
+        return copied
+
+    def verify(self):
+        """Indexes of chunks whose target data no longer matches its crc."""
+        bad = []
+        buf = mmap.mmap(-1, self.blocksize)
+        fd = os.open(self.dst_path, os.O_RDONLY)
+        reader = io.FileIO(fd, 'r', closefd=False)
+        try:
+            for index in range(self.checkpoint.nchunks):
+                if not self.checkpoint.is_done(index):
+                    continue
+                offset = index * self.chunk_size
+                end = min(offset + self.chunk_size, self.size)
+                crc = 0
+                os.lseek(fd, offset, os.SEEK_SET)
+                while offset < end:
+                    n = min(reader.readinto(buf) or 0, end - offset)
+                    if n <= 0:
+                        break
+                    data = _slice(buf, 0, n)
+                    crc = zlib.crc32(data, crc)
+                    data = None
+                    offset += n
+                if crc & 0xffffffff != self.checkpoint.crcs[index]:
+                    bad.append(index)
+        finally:
+            os.close(fd)
+            buf.close()
+        return bad
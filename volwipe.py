@@ -0,0 +1,250 @@
+# author:sursen
+# VolumeWiper: clears a volume with the cheapest method its policy allows
+#   zero:  punch-hole (files), BLKDISCARD when discard zeroes data,
+#          BLKZEROOUT, parallel zero writes as the last resort
+#   shred: parallel overwrite passes with random data
+import os
+import mmap
+import stat
+import time
+import errno
+import fcntl
+import ctypes
+import struct
+import logging
+import ctypes.util
+from cinder.volume.drivers.sursen import common
+
+LOG = logging.getLogger(__name__)
+
+# wipes run in OS threads of their own: they block in the kernel, and
+# the io priority they set dies with them instead of sticking to a
+# shared (tpool) thread
+threading = common.native_module('threading')
+
+BLKGETSIZE64 = 0x80081272
+BLKDISCARD = 0x1277
+BLKDISCARDZEROES = 0x127c
+BLKZEROOUT = 0x127f
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+SYS_IOPRIO_SET = {'x86_64': 251, 'i686': 289, 'aarch64': 30,
+                  'ppc64le': 273, 's390x': 282}.get(os.uname()[4])
+# ioctl ranges are split so one call never blocks for too long
+IOCTL_CHUNK = 1024 * 1024 * 1024
+
+_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS)
+
+try:
+    _slice = buffer
+except NameError:
+    def _slice(buf, offset, size):
+        return memoryview(buf)[offset:offset + size]
+
+
+def _libc():
+    return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+
+
+def parse_ionice(spec):
+    """'-c3' / '-c2 -n7' -> (class, level), None if not parsable."""
+    if not spec:
+        return None
+    args = spec.replace('-c', ' -c ').replace('-n', ' -n ').split()
+    ioclass, level = None, 0
+    for (flag, value) in zip(args[::2], args[1::2]):
+        if not value.isdigit():
+            return None
+        if flag == '-c':
+            ioclass = int(value)
+        elif flag == '-n':
+            level = int(value)
+    if ioclass is None:
+        return None
+    return (ioclass, level)
+
+
+def set_thread_ionice(spec):
+    """Apply an ionice spec to the calling thread, False if not possible."""
+    prio = parse_ionice(spec)
+    if prio is None:
+        return False
+    if SYS_IOPRIO_SET is None:
+        return False
+    value = (prio[0] << IOPRIO_CLASS_SHIFT) | prio[1]
+    if _libc().syscall(SYS_IOPRIO_SET, IOPRIO_WHO_PROCESS, 0, value) < 0:
+        LOG.warn('Failed to set io priority %s' % spec)
+        return False
+    return True
+
+
+class VolumeWiper(object):
+    """Wipes a block device or a file backing a LUN.
+
+    wipe() probes the target and returns a dict with the method used,
+    the bytes cleared, seconds and MB/s. Zero writes and shred passes
+    are split over workers writing disjoint chunks. All the I/O runs in
+    new OS threads, with ionice applied to them only.
+    """
+    def __init__(self, method='zero', blocksize=1024 * 1024, workers=4,
+                 chunk_size=256 * 1024 * 1024, ionice=None, shred_passes=3):
+        self.method = method
+        self.blocksize = blocksize
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.ionice = ionice
+        self.shred_passes = shred_passes
+
+    def _get_size(self, fd, st):
+        if stat.S_ISBLK(st.st_mode):
+            buf = fcntl.ioctl(fd, BLKGETSIZE64, struct.pack('Q', 0))
+            return struct.unpack('Q', buf)[0]
+        return st.st_size
+
+    def _discard_zeroes(self, fd):
+        try:
+            buf = fcntl.ioctl(fd, BLKDISCARDZEROES, struct.pack('I', 0))
+        except IOError:
+            return False
+        return struct.unpack('I', buf)[0] == 1
+
+    def _range_ioctl(self, fd, request, size):
+        offset = 0
+        while offset < size:
+            length = min(IOCTL_CHUNK, size - offset)
+            fcntl.ioctl(fd, request, struct.pack('QQ', offset, length))
+            offset += length
+
+    def _punch_hole(self, fd, size):
+        func = _libc().fallocate64
+        func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong,
+                         ctypes.c_longlong]
+        if func(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, 0, size) < 0:
+            err = ctypes.get_errno()
+            raise IOError(err, os.strerror(err))
+
+    def _write_worker(self, path, chunks, pattern, errors):
+        if self.ionice:
+            set_thread_ionice(self.ionice)
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            while chunks and not errors:
+                try:
+                    (offset, end) = chunks.pop()
+                except IndexError:
+                    break
+                os.lseek(fd, offset, os.SEEK_SET)
+                while offset < end:
+                    n = os.write(fd, _slice(pattern, 0,
+                                            min(self.blocksize, end - offset)))
+                    offset += n
+            os.fsync(fd)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            os.close(fd)
+
+    def _write_pass(self, path, size, pattern):
+        chunks = [(off, min(off + self.chunk_size, size))
+                  for off in range(0, size, self.chunk_size)]
+        chunks.reverse()
+        errors = []
+        threads = [threading.Thread(target=self._write_worker,
+                                    args=(path, chunks, pattern, errors))
+                   for _ in range(max(1, min(self.workers, len(chunks))))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+    def _write_zeroes(self, path, size):
+        pattern = mmap.mmap(-1, self.blocksize)
+        try:
+            self._write_pass(path, size, pattern)
+        finally:
+            pattern.close()
+
+    def _shred(self, path, size):
+        for _ in range(self.shred_passes):
+            pattern = mmap.mmap(-1, self.blocksize)
+            try:
+                pattern.write(os.urandom(self.blocksize))
+                self._write_pass(path, size, pattern)
+            finally:
+                pattern.close()
+
+    def _zero(self, path, fd, st, size):
+        if stat.S_ISREG(st.st_mode):
+            try:
+                self._punch_hole(fd, size)
+                return 'punch_hole'
+            except (IOError, OSError) as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+        elif stat.S_ISBLK(st.st_mode):
+            if self._discard_zeroes(fd):
+                try:
+                    self._range_ioctl(fd, BLKDISCARD, size)
+                    return 'discard'
+                except IOError as e:
+                    if e.errno not in _UNSUPPORTED:
+                        raise
+            try:
+                self._range_ioctl(fd, BLKZEROOUT, size)
+                return 'zeroout'
+            except IOError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+        self._write_zeroes(path, size)
+        return 'write_zeroes'
+
+    def wipe(self, path, size=None):
+        """Clear the first size bytes of path (default: all of it)."""
+        if self.method == 'none':
+            return {'method': 'none', 'bytes': 0, 'seconds': 0, 'mbps': 0}
+        if self.method not in ('zero', 'shred'):
+            raise ValueError('unknown volume_clear method %s' % self.method)
+        outcome = []
+
+        def _run():
+            try:
+                if self.ionice:
+                    set_thread_ionice(self.ionice)
+                outcome.append((True, self._wipe(path, size)))
+            except Exception as e:
+                outcome.append((False, e))
+        thread = threading.Thread(target=_run)
+        thread.start()
+        thread.join()
+        (ok, value) = outcome[0]
+        if not ok:
+            raise value
+        return value
+
+    def _wipe(self, path, size):
+        start = time.time()
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            st = os.fstat(fd)
+            full_size = self._get_size(fd, st)
+            if size is None or size > full_size:
+                size = full_size
+            if self.method == 'shred':
+                self._shred(path, size)
+                method = 'shred'
+            else:
+                method = self._zero(path, fd, st, size)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        elapsed = max(time.time() - start, 1e-6)
+        result = {'method': method, 'bytes': size, 'seconds': elapsed,
+                  'mbps': size / elapsed / (1024 * 1024)}
+        LOG.info('Wiped %d bytes of %s with %s in %.1fs (%.1f MB/s)'
+                 % (size, path, method, elapsed, result['mbps']))
+        return result
@@ -0,0 +1,357 @@
+# author:sursen
+# DatasetColumns: one `zfs list -Hp` parsed into columns, sizes as integer
+#                 arrays (numpy for big pools when it is installed)
+# DatasetTable: the pool's datasets from one `zfs list -Hp`, kept in memory,
+#               and the pool capacity summed from them
+# ZfsOps: snapshot/destroy requests arriving together run as one zfs
+#         command (or one channel program), listings come from the table
+import os
+import time
+import array
+import tempfile
+import threading
+from cinder.openstack.common import log as logging
+from cinder.openstack.common import processutils as putils
+
+LOG = logging.getLogger(__name__)
+
+LIST_FIELDS = ('name', 'type', 'used', 'avail', 'refer', 'volsize', 'origin')
+_INT_FIELDS = ('used', 'avail', 'refer', 'volsize')
+
+# runs every destroy of the batch inside one txg
+_DESTROY_PROGRAM = """
+args = ...
+failed = {}
+for _, name in ipairs(args["argv"]) do
+    err = zfs.sync.destroy(name)
+    if err ~= 0 then
+        failed[name] = err
+    end
+end
+return failed
+"""
+
+
+# python 2 has no 'Q', its 'L' is 64 bit on the 64 bit hosts we run on
+try:
+    array.array('Q')
+    _TYPECODE = 'Q'
+except ValueError:
+    _TYPECODE = 'L'
+_NUMPY = []
+
+
+def _numpy():
+    # optional and slow to import, only loaded for big listings
+    if not _NUMPY:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _NUMPY.append(numpy)
+    return _NUMPY[0]
+
+
+class DatasetColumns(object):
+    """Rows of a `zfs list -Hp` kept as columns.
+
+    Text fields are lists of str, size fields integer byte columns:
+    array('Q'), or numpy uint64 arrays from numpy_threshold rows on when
+    numpy is installed. Sums stay integers. Reads like the old
+    {name: row} mapping: `name in`, iteration over names, get(name).
+    """
+    def __init__(self, fields=LIST_FIELDS, numpy_threshold=2048):
+        self.fields = tuple(fields)
+        self.numpy_threshold = numpy_threshold
+        self.columns = dict((f, []) for f in self.fields)
+        # size field -> row indexes that were '-'
+        self._unset = dict((f, set()) for f in self.fields
+                           if f in _INT_FIELDS)
+        self._index = {}
+
+    def load(self, out):
+        rows = [line.split('\t') for line in out.splitlines()
+                if line.strip()]
+        width = len(self.fields)
+        rows = [r for r in rows if len(r) >= width]
+        cells = list(zip(*rows)) if rows else [()] * width
+        np = _numpy() if len(rows) >= self.numpy_threshold else None
+        for (field, column) in zip(self.fields, cells):
+            if field not in _INT_FIELDS:
+                self.columns[field] = [v if v != '-' else None
+                                       for v in column]
+                continue
+            self._unset[field] = set(i for (i, v) in enumerate(column)
+                                     if v == '-')
+            values = [v if v != '-' else '0' for v in column]
+            if np is not None:
+                self.columns[field] = np.array(values).astype(np.uint64)
+            else:
+                self.columns[field] = array.array(
+                    _TYPECODE, [int(v) for v in values])
+        self._index = dict((n, i) for (i, n) in
+                           enumerate(self.columns['name']))
+        return self
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self.columns['name'])
+
+    def get(self, name, default=None):
+        """The row of name as {field: value}, '-' sizes as None."""
+        i = self._index.get(name)
+        if i is None:
+            return default
+        row = {}
+        for field in self.fields:
+            if field in _INT_FIELDS:
+                row[field] = None if i in self._unset[field] \
+                    else int(self.columns[field][i])
+            else:
+                row[field] = self.columns[field][i]
+        return row
+
+    def total(self, field, type_=None):
+        """Sum of a size column, of the rows of type type_ only if set."""
+        column = self.columns[field]
+        vectorized = hasattr(column, 'sum')
+        if type_ is None:
+            return int(column.sum()) if vectorized else sum(column)
+        types = self.columns['type']
+        if vectorized:
+            mask = _numpy().array(types) == type_
+            return int(column[mask].sum())
+        return sum(v for (v, t) in zip(column, types) if t == type_)
+
+    def count(self, type_):
+        return self.columns['type'].count(type_)
+
+
+def parse_list(out, fields=LIST_FIELDS, numpy_threshold=2048):
+    """`zfs list -Hp -o <fields>` output -> DatasetColumns."""
+    return DatasetColumns(fields, numpy_threshold).load(out)
+
+
+class DatasetTable(object):
+    """Datasets under root, refreshed by one zfs list at most every ttl s.
+
+    Callers finding the table stale at the same time wait for a single
+    listing and share its rows.
+    """
+    def __init__(self, execute, root, ttl=5.0):
+        self.execute = execute
+        self.root = root
+        self.ttl = ttl
+        self._rows = parse_list('')
+        self._loaded = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        (out, _err) = self.execute('zfs', 'list', '-Hp', '-r', '-t', 'all',
+                                   '-o', ','.join(LIST_FIELDS), self.root,
+                                   run_as_root=True)
+        rows = parse_list(out)
+        with self._lock:
+            self._rows = rows
+            self._loaded = time.time()
+        return rows
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = None
+
+    def _stale(self):
+        loaded = self._loaded
+        return loaded is None or time.time() - loaded > self.ttl
+
+    def rows(self):
+        if self._stale():
+            with self._refresh_lock:
+                # whoever held the lock may have just listed
+                if self._stale():
+                    return self.refresh()
+        return self._rows
+
+    def get(self, name):
+        return self.rows().get(name)
+
+    def exists(self, name):
+        return name in self.rows()
+
+    def snapshots_of(self, dataset):
+        prefix = dataset + '@'
+        return sorted(n for n in self.rows() if n.startswith(prefix))
+
+    def children(self, dataset):
+        prefix = dataset + '/'
+        return sorted(n for n in self.rows() if n.startswith(prefix))
+
+    def capacity(self):
+        """Byte counts of root and its zvols, with the allocated and
+        provisioned ratios of the root size."""
+        rows = self.rows()
+        root = rows.get(self.root)
+        if root is None:
+            raise ValueError('%s not in the zfs listing' % self.root)
+        used = root['used'] or 0
+        avail = root['avail'] or 0
+        total = used + avail
+        provisioned = rows.total('volsize', 'volume')
+        return {'total': total,
+                'free': avail,
+                'allocated': used,
+                'provisioned': provisioned,
+                'volumes': rows.count('volume'),
+                'allocated_ratio': float(used) / total if total else 0.0,
+                'provisioned_ratio':
+                    float(provisioned) / total if total else 0.0}
+
+
+class _Request(object):
+    def __init__(self, name):
+        self.name = name
+        self.error = None
+        self.done = threading.Event()
+
+
+class ZfsOps(object):
+    """Snapshots and destroys of concurrent callers, batched.
+
+    The first caller of a kind waits batch_window seconds, then runs
+    everything queued meanwhile: snapshots as one atomic
+    `zfs snapshot a@s b@s ...`, destroys as one channel program when
+    channel_programs is set, else one `zfs destroy ds@s1,s2` per
+    dataset. If a batch fails its requests are retried one by one so
+    each caller gets its own error.
+    """
+    def __init__(self, execute, pool, batch_window=0.05,
+                 channel_programs=False, list_ttl=5.0):
+        self.execute = execute
+        self.pool = pool
+        self.batch_window = batch_window
+        self.channel_programs = channel_programs
+        self.table = DatasetTable(execute, pool, list_ttl)
+        self.commands = 0
+        self._pending = {'snapshot': [], 'destroy': []}
+        self._leading = {'snapshot': False, 'destroy': False}
+        self._lock = threading.Lock()
+
+    def _zfs(self, *args):
+        self.commands += 1
+        return self.execute('zfs', *args, run_as_root=True)
+
+    def _submit(self, kind, name):
+        request = _Request(name)
+        with self._lock:
+            self._pending[kind].append(request)
+            leader = not self._leading[kind]
+            self._leading[kind] = True
+        if leader:
+            if self.batch_window:
+                time.sleep(self.batch_window)
+            with self._lock:
+                batch = self._pending[kind]
+                self._pending[kind] = []
+                self._leading[kind] = False
+            try:
+                getattr(self, '_run_' + kind)(batch)
+            except Exception as e:
+                for r in batch:
+                    if r.error is None:
+                        r.error = e
+            finally:
+                self.table.invalidate()
+                for r in batch:
+                    r.done.set()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+    def _run_each(self, batch, func):
+        for request in batch:
+            try:
+                func(request.name)
+            except putils.ProcessExecutionError as e:
+                request.error = e
+
+    def _run_snapshot(self, batch):
+        names = sorted(set(r.name for r in batch))
+        try:
+            self._zfs('snapshot', *names)
+        except putils.ProcessExecutionError:
+            if len(names) == 1:
+                raise
+            LOG.warn('Batched snapshot of %d datasets failed, retrying '
+                     'one by one' % len(names))
+            self._run_each(batch, lambda n: self._zfs('snapshot', n))
+
+    def _run_destroy(self, batch):
+        names = sorted(set(r.name for r in batch))
+        try:
+            if self.channel_programs and len(names) > 1:
+                failed = self._destroy_program(names)
+                for r in batch:
+                    if r.name in failed:
+                        r.error = putils.ProcessExecutionError(
+                            description='zfs destroy %s failed with errno %s'
+                            % (r.name, failed[r.name]), cmd='zfs program')
+                return
+            self._destroy_grouped(names)
+        except putils.ProcessExecutionError:
+            if len(names) == 1:
+                raise
+            LOG.warn('Batched destroy of %d datasets failed, retrying '
+                     'one by one' % len(names))
+            self.table.invalidate()
+            rows = self.table.rows()
+            # some of the batch may be gone already
+            self._run_each([r for r in batch if r.name in rows],
+                           lambda n: self._zfs('destroy', n))
+
+    def _destroy_grouped(self, names):
+        # snapshots of one dataset go in one `zfs destroy ds@a,b,c`
+        groups = {}
+        for name in names:
+            if '@' in name:
+                (dataset, snap) = name.split('@', 1)
+                groups.setdefault(dataset, []).append(snap)
+            else:
+                self._zfs('destroy', name)
+        for dataset in sorted(groups):
+            self._zfs('destroy', '%s@%s' % (dataset, ','.join(groups[dataset])))
+
+    def _destroy_program(self, names):
+        """Destroy names in one txg, returns {name: errno} of failures."""
+        pool = self.pool.split('/')[0]
+        with tempfile.NamedTemporaryFile(suffix='.lua') as script:
+            script.write(_DESTROY_PROGRAM.encode('utf-8'))
+            script.flush()
+            os.chmod(script.name, 0o644)
+            (out, _err) = self._zfs('program', pool, script.name, *names)
+        failed = {}
+        for line in out.splitlines():
+            # "        pool/vol@snap: 16" lines of the returned table
+            (name, sep, value) = line.strip().rpartition(': ')
+            if sep and name in names and value.strip().isdigit():
+                failed[name] = int(value)
+        return failed
+
+    def snapshot(self, dataset, snapshot_name):
+        self._submit('snapshot', '%s@%s' % (dataset, snapshot_name))
+
+    def destroy(self, name):
+        self._submit('destroy', name)
+
+    def clone(self, snapshot, dataset, properties=None):
+        # channel programs cannot clone, one process per clone
+        args = ['clone']
+        for (key, value) in sorted((properties or {}).items()):
+            args.extend(['-o', '%s=%s' % (key, value)])
+        self._zfs(*(args + [snapshot, dataset]))
+        self.table.invalidate()